@@ -0,0 +1,255 @@
+"""Load test of the API running in-process, without Postgres, Redis or a server.
+
+The app is served through httpx's ASGI transport on top of SQLite (aiosqlite)
+and fakeredis, with the schema created from the models. Every scenario runs a
+fixed number of requests at a fixed concurrency and the results are printed
+(or written with --output) as JSON, so a baseline can be committed and diffed
+against in review:
+
+    python benchmark.py --transactions 20000 --concurrency 50 --output baseline.json
+
+Numbers are only comparable between runs on the same machine with the same
+arguments. A request counts as a cache hit when it didn't run any SQL.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+
+# The settings need a database and Redis to point at even though neither is
+# used here
+for variable in ("DATABASE_USER", "DATABASE_NAME", "DATABASE_PASSWORD"):
+    os.environ.setdefault(variable, "benchmark")
+os.environ.setdefault("DATABASE_SERVER", "localhost")
+os.environ.setdefault("REDIS_HOST", "localhost")
+
+from fakeredis import FakeAsyncRedis
+from httpx import ASGITransport, AsyncClient
+from orjson import OPT_INDENT_2, dumps
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import db
+import redis_client
+from main import app
+from settings import settings
+from transaction import batcher
+from transaction.aggregates import rebuild_aggregates
+from transaction.cache import listen_for_invalidations, local_cache
+from transaction.enums import TransactionType
+from transaction.models import Transaction
+
+SCENARIOS = ["list_transactions", "read_transaction", "create_transaction", "analytics"]
+
+# Number of SQL statements run by the request being handled, None outside of
+# a benchmarked request
+statements: ContextVar[list[int] | None] = ContextVar("statements", default=None)
+
+
+def count_statement(*_):
+    if (counter := statements.get()) is not None:
+        counter[0] += 1
+
+
+def transaction_row(rnd: random.Random, user_id: int, days: int) -> dict:
+    return {
+        "user_id": user_id,
+        "full_name": f"User {user_id}",
+        "transaction_date": datetime(2024, 1, 1, tzinfo=timezone.utc)
+        + timedelta(minutes=rnd.randrange(days * 24 * 60)),
+        "transaction_amount": round(rnd.uniform(1, 1000), 2),
+        "transaction_type": rnd.choice(list(TransactionType)),
+    }
+
+
+async def seed(session_factory, args, rnd: random.Random):
+    async with session_factory() as session:
+        for offset in range(0, args.transactions, 1000):
+            await session.exec(
+                insert(Transaction),
+                params=[
+                    transaction_row(rnd, rnd.randint(1, args.users), args.days)
+                    for _ in range(min(1000, args.transactions - offset))
+                ],
+            )
+        await rebuild_aggregates(session)
+        await session.commit()
+
+
+def request(scenario: str, rnd: random.Random, args) -> tuple[str, str, dict]:
+    user_id = rnd.randint(1, args.users)
+
+    if scenario == "list_transactions":
+        return "GET", "/core/", {"params": {"user_id": user_id}}
+    if scenario == "read_transaction":
+        return "GET", f"/core/{rnd.randint(1, args.transactions)}", {}
+    if scenario == "create_transaction":
+        row = transaction_row(rnd, user_id, args.days)
+        row["transaction_date"] = row["transaction_date"].isoformat()
+        return "POST", "/core/", {"json": row}
+    return "GET", f"/core/{user_id}/analytics", {}
+
+
+async def timed_request(client: AsyncClient, method: str, url: str, kwargs: dict):
+    statements.set([0])
+    start = perf_counter()
+    response = await client.request(method, url, **kwargs)
+    elapsed = perf_counter() - start
+    return elapsed, response.status_code < 400, statements.get()[0] == 0
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    # Nearest rank on the sorted values
+    return values[max(0, round(fraction * len(values) + 0.5) - 1)]
+
+
+async def run_scenario(client: AsyncClient, scenario: str, args, rnd: random.Random):
+    requests = [request(scenario, rnd, args) for _ in range(args.requests)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run(method, url, kwargs):
+        async with semaphore:
+            return await timed_request(client, method, url, kwargs)
+
+    start = perf_counter()
+    results = await asyncio.gather(*[run(*request) for request in requests])
+    elapsed = perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _, _ in results)
+    return {
+        "requests": len(results),
+        "errors": sum(not ok for _, ok, _ in results),
+        "requests_per_second": round(len(results) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 3),
+            "p95": round(percentile(latencies, 0.95), 3),
+            "p99": round(percentile(latencies, 0.99), 3),
+            "max": round(latencies[-1], 3),
+        },
+        "cache_hit_rate": round(sum(hit for _, _, hit in results) / len(results), 3),
+    }
+
+
+async def main(args):
+    rnd = random.Random(args.seed)
+
+    database_url = args.database_url or (
+        f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'benchmark.db'}"
+    )
+    # SQLite allows a single writer, concurrent writes would fail on the lock
+    # instead of queueing for it
+    pool = (
+        {"pool_size": 1, "max_overflow": 0} if database_url.startswith("sqlite") else {}
+    )
+    engine = create_async_engine(database_url, **pool)
+    event.listen(engine.sync_engine, "before_cursor_execute", count_statement)
+    session_factory = async_sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False
+    )
+    rc = FakeAsyncRedis()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+    await seed(session_factory, args, rnd)
+
+    async def get_session():
+        async with session_factory() as session:
+            yield session
+
+    async def get_client():
+        return rc
+
+    app.dependency_overrides[db.get_session] = get_session
+    app.dependency_overrides[redis_client.get_client] = get_client
+    db.async_session = batcher.async_session = session_factory
+    settings.WRITE_BATCHING_ENABLED = args.write_batching
+
+    # The analytics worker isn't started, fakeredis doesn't block on stream
+    # reads. Analytics are recomputed by the requests that miss instead.
+    listener = None
+    if args.local_cache:
+        listener = asyncio.create_task(listen_for_invalidations(rc))
+        while not local_cache.subscribed:
+            await asyncio.sleep(0.01)
+
+    results = {}
+    async with AsyncClient(
+        transport=ASGITransport(app, raise_app_exceptions=False),
+        base_url="http://benchmark",
+    ) as client:
+        for scenario in args.scenarios:
+            results[scenario] = await run_scenario(client, scenario, args, rnd)
+
+    if listener:
+        listener.cancel()
+    await rc.aclose()
+    await engine.dispose()
+
+    return {
+        "config": {
+            key: getattr(args, key)
+            for key in (
+                "transactions",
+                "users",
+                "days",
+                "requests",
+                "concurrency",
+                "seed",
+                "local_cache",
+                "write_batching",
+            )
+        },
+        "results": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transactions", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        choices=SCENARIOS,
+        help="Can be repeated, all of them by default",
+    )
+    parser.add_argument("--no-local-cache", dest="local_cache", action="store_false")
+    parser.add_argument(
+        "--write-batching",
+        action="store_true",
+        help="Group commit the creates, see WRITE_BATCHING_ENABLED. Their SQL then "
+        "runs outside the requests, which all count as cache hits",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="SQLite in a temporary directory by default, its tables are dropped and recreated",
+    )
+    parser.add_argument("--output", type=Path, help="Written to stdout by default")
+
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or SCENARIOS
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = dumps(asyncio.run(main(args)), option=OPT_INDENT_2)
+
+    if args.output:
+        args.output.write_bytes(report + b"\n")
+    else:
+        print(report.decode())
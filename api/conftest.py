@@ -1,20 +1,25 @@
-import pytest
+import pytest_asyncio
 
-from redis_client import get_client
+from redis_client import create_client
+from transaction.cache import INVALIDATE_ALL, REDIS_CHANNEL_INVALIDATIONS
 
 
-@pytest.fixture(scope="function")
+@pytest_asyncio.fixture(scope="function")
 async def redis_client():
-    async for rc in get_client():
-        # Code to run before each test
-        print("Setting up test environment")
+    rc = create_client()
 
-        rc.delete("transactions:1:1")
-        # ... other setup steps
+    # Code to run before each test
+    print("Setting up test environment")
 
-        yield rc  # Yield control back to the test function
+    await rc.delete("transactions:1:0:first")
+    # ... other setup steps
 
-        # Code to run after each test
-        print("Tearing down test environment")
-        rc.flushall()
-        # ... cleanup steps
+    yield rc  # Yield control back to the test function
+
+    # Code to run after each test
+    print("Tearing down test environment")
+    await rc.flushall()
+    # The API processes' local caches aren't told about a flush otherwise
+    await rc.publish(REDIS_CHANNEL_INVALIDATIONS, INVALIDATE_ALL)
+    await rc.aclose()
+    # ... cleanup steps
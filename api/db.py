@@ -1,20 +1,186 @@
-from sqlmodel import create_engine, SQLModel, Session
+import logging
+from pathlib import Path
+from time import monotonic
+
+from alembic import command
+from alembic.config import Config
+from sqlmodel import Session
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import Connection, Engine, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    async_sessionmaker,
+    create_async_engine,
+)
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
 
 from settings import settings
 
-engine = create_async_engine(settings.DB_CONNECTION_STRING, echo=True)
+logger = logging.getLogger(__name__)
+
+ALEMBIC_CONFIG = Path(__file__).parent / "alembic.ini"
+
+# Set on responses to writes, reads of a client that has it go to the primary
+READ_PRIMARY_COOKIE = "read_primary"
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+def make_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        # The asyncpg dialect keeps prepared statements per connection, so the
+        # same queries are only parsed and planned once per connection
+        make_url(url).update_query_dict(
+            {
+                "prepared_statement_cache_size": str(
+                    settings.DATABASE_STATEMENT_CACHE_SIZE
+                )
+            }
+        ),
+        echo=settings.DATABASE_ECHO,
+        pool_size=settings.DATABASE_POOL_SIZE,
+        max_overflow=settings.DATABASE_MAX_OVERFLOW,
+        pool_timeout=settings.DATABASE_POOL_TIMEOUT_SECONDS,
+        pool_recycle=settings.DATABASE_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=settings.DATABASE_POOL_PRE_PING,
+    )
+
+
+engine = make_engine(settings.DB_CONNECTION_STRING)
+
+# Sessions are cheap, the factory is built once and shared by requests and
+# anything that needs a session of its own (exports, the analytics worker)
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+replica_engines = [make_engine(url) for url in settings.DATABASE_REPLICA_URLS]
+
+
+class ReplicaSession(Session):
+    """Binds to a replica when it first needs a connection, sessions that are
+    never used (the response was cached) don't take one."""
+
+    read_bind: Engine | None = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs) -> Engine:
+        if self.read_bind is None:
+            self.read_bind = self.info["replicas"].connect(self)
+        return self.read_bind
+
+
+class ReplicaRouter:
+    """Hands out sessions on the read replicas in turn. A replica that can't
+    be connected to is left out for retry_after seconds, with none left the
+    session is on the primary."""
+
+    def __init__(
+        self, engines: list[AsyncEngine], primary: AsyncEngine, retry_after: float
+    ):
+        self.engines = engines
+        self.primary = primary
+        self.retry_after = retry_after
+        self.down_until = [0.0] * len(engines)
+        self.next = 0
+        self.session = async_sessionmaker(
+            class_=AsyncSession,
+            sync_session_class=ReplicaSession,
+            expire_on_commit=False,
+            info={"replicas": self},
+        )
+
+    def connect(self, session: Session) -> Engine:
+        count = len(self.engines)
+        start, self.next = self.next, (self.next + 1) % max(count, 1)
+
+        for index in (i % count for i in range(start, start + count)):
+            if self.down_until[index] > monotonic():
+                continue
+
+            bind = self.engines[index].sync_engine
+            try:
+                # The connection stays with the session for its queries
+                session.connection(bind_arguments={"bind": bind})
+                return bind
+            except Exception:
+                self.down_until[index] = monotonic() + self.retry_after
+                logger.exception("Read replica %d is unavailable", index)
+
+        return self.primary.sync_engine
+
+
+replicas = ReplicaRouter(
+    replica_engines, engine, settings.DATABASE_REPLICA_RETRY_SECONDS
+)
+
+
+async def use_primary(session: AsyncSession):
+    """Move a read session to the primary, for reads that must see the latest
+    writes. Sessions that are already on the primary are left as they are."""
+
+    sync_session = session.sync_session
+    if not isinstance(sync_session, ReplicaSession):
+        return
+
+    primary = sync_session.info["replicas"].primary.sync_engine
+    if sync_session.read_bind not in (None, primary):
+        # Gives the replica's connection back, the next query takes one from
+        # the primary
+        await session.close()
+    sync_session.read_bind = primary
+
+
+def read_session(connection: HTTPConnection) -> AsyncSession:
+    """A session for queries that only read, on a replica unless the client
+    wrote in the last few seconds (it would miss its own write otherwise)."""
+
+    if not replica_engines or connection.cookies.get(READ_PRIMARY_COOKIE):
+        return async_session()
+    return replicas.session()
+
+
+class ReadYourWritesMiddleware:
+    """Sends the read primary cookie with every successful write, for
+    DATABASE_READ_YOUR_WRITES_SECONDS, about the lag of the replicas."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in WRITE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                MutableHeaders(scope=message).append(
+                    "Set-Cookie",
+                    f"{READ_PRIMARY_COOKIE}=1; "
+                    f"Max-Age={settings.DATABASE_READ_YOUR_WRITES_SECONDS}; "
+                    "Path=/; HttpOnly; SameSite=Lax",
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+def run_migrations(connection: Connection):
+    config = Config(ALEMBIC_CONFIG)
+    config.attributes["connection"] = connection
+    command.upgrade(config, "head")
+
 
 async def init_db():
-    async with engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
+    # The schema is owned by the migrations in migrations/versions, new schema
+    # changes go there as a new revision (alembic revision -m "...")
+    async with engine.connect() as conn:
+        await conn.run_sync(run_migrations)
+        await conn.commit()
 
 
 async def get_session() -> AsyncSession: # type: ignore
-    async_session = sessionmaker(
-        engine, class_=AsyncSession, expire_on_commit=False
-    )
     async with async_session() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+async def get_read_session(connection: HTTPConnection) -> AsyncSession:  # type: ignore
+    async with read_session(connection) as session:
+        yield session
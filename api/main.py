@@ -1,17 +1,52 @@
+import asyncio
+from contextlib import suppress
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 
-from db import init_db
+import metrics
+from db import ReadYourWritesMiddleware, engine, init_db, replica_engines
+from redis_client import create_client
 from settings import settings
 
+from transaction import partitions, warmup, worker
+from transaction.batcher import batcher
+from transaction.cache import listen_for_invalidations
 from transaction.routes import transaction_router
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
+    if settings.DATABASE_MIGRATE_ON_STARTUP:
+        await init_db()
+    app.state.redis = create_client()
+
+    tasks = []
+    if settings.LOCAL_CACHE_ENABLED:
+        tasks.append(asyncio.create_task(listen_for_invalidations(app.state.redis)))
+    if settings.ANALYTICS_WORKER_ENABLED:
+        tasks.append(asyncio.create_task(worker.run(app.state.redis)))
+    if settings.TRANSACTION_PARTITION_MAINTENANCE_ENABLED:
+        tasks.append(asyncio.create_task(partitions.run()))
+    if settings.CACHE_WARMUP_ENABLED:
+        tasks.append(asyncio.create_task(warmup.run(app.state.redis)))
+
     yield
 
-app = FastAPI(lifespan=lifespan)
+    await batcher.drain()
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await app.state.redis.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(transaction_router)
 
+if replica_engines:
+    app.add_middleware(ReadYourWritesMiddleware)
+
+if settings.METRICS_ENABLED:
+    metrics.install(app, engine, *replica_engines)
+
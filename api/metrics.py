@@ -0,0 +1,259 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import MutableHeaders
+
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Where a request's time goes, in the order they are reported
+TIMERS = ("redis", "db", "serialize")
+
+
+class RequestMetrics:
+    """Timings and counters of the request being handled."""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(TIMERS, 0.0)
+        self.queries = 0
+        self.rows = 0
+        self.cache = defaultdict(int)
+
+    def server_timing(self, total: float) -> str:
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.3f}"
+            for name, seconds in [*self.seconds.items(), ("total", total)]
+        )
+
+
+# Only set while a request is being handled with metrics enabled, every hook
+# below does nothing but this lookup otherwise
+current: ContextVar[RequestMetrics | None] = ContextVar("metrics", default=None)
+
+
+@contextmanager
+def timer(name: str):
+    metrics = current.get()
+    if metrics is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.seconds[name] += perf_counter() - start
+
+
+def record_cache(key: str, result: str):
+    """result is one of "local" (served from process memory), "hit" or
+    "miss". Keys are grouped by their first segment (analytics, transaction,
+    transactions, generation)."""
+
+    if metrics := current.get():
+        metrics.cache[(key.split(":", 1)[0], result)] += 1
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current.get() is not None:
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if (metrics := current.get()) is None or not conn.info.get("query_start"):
+        return
+
+    metrics.seconds["db"] += perf_counter() - conn.info["query_start"].pop()
+    metrics.queries += 1
+    metrics.rows += cursor_rows(conn, cursor)
+
+
+def cursor_rows(conn, cursor) -> int:
+    # SQLAlchemy's asyncpg cursor adapter fetches every row of a result up
+    # front, into a private list, which is read rather than counting rows as
+    # the caller fetches them. For other drivers, and for writes, rowcount is
+    # the number of rows written.
+    if conn.dialect.driver == "asyncpg":
+        rows = getattr(cursor, "_rows", None)
+        if rows is not None:
+            return len(rows)
+    return max(cursor.rowcount, 0)
+
+
+def handle_error(context):
+    # after_cursor_execute doesn't run for a statement that raised, its start
+    # would be left on the pooled connection for the next statement to pop
+    conn = context.connection
+    if conn is None or not conn.info.get("query_start"):
+        return
+
+    start = conn.info["query_start"].pop()
+    if metrics := current.get():
+        metrics.seconds["db"] += perf_counter() - start
+
+
+class Registry:
+    """Process wide totals, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.duration_buckets = defaultdict(lambda: [0] * len(REQUEST_DURATION_BUCKETS))
+        self.duration_sum = defaultdict(float)
+        self.duration_count = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.queries = defaultdict(int)
+        self.rows = defaultdict(int)
+        self.cache = defaultdict(int)
+
+    def observe(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        duration: float,
+        metrics: RequestMetrics,
+    ):
+        self.requests[(method, route, status)] += 1
+
+        buckets = self.duration_buckets[route]
+        bucket = bisect_left(REQUEST_DURATION_BUCKETS, duration)
+        if bucket < len(buckets):
+            buckets[bucket] += 1
+        self.duration_sum[route] += duration
+        self.duration_count[route] += 1
+
+        for name, seconds in metrics.seconds.items():
+            self.seconds[(route, name)] += seconds
+        self.queries[route] += metrics.queries
+        self.rows[route] += metrics.rows
+        for (family, result), count in metrics.cache.items():
+            self.cache[(family, result)] += count
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_requests_total Requests handled.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(
+                f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}'
+            )
+
+        lines += [
+            "# HELP http_request_duration_seconds Time to handle a request.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for route, buckets in sorted(self.duration_buckets.items()):
+            cumulative = 0
+            for le, count in zip(REQUEST_DURATION_BUCKETS, buckets):
+                cumulative += count
+                lines.append(
+                    f'http_request_duration_seconds_bucket{{route="{route}",le="{le}"}} {cumulative}'
+                )
+            lines += [
+                f'http_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {self.duration_count[route]}',
+                f'http_request_duration_seconds_sum{{route="{route}"}} {self.duration_sum[route]}',
+                f'http_request_duration_seconds_count{{route="{route}"}} {self.duration_count[route]}',
+            ]
+
+        lines += [
+            "# HELP http_request_component_seconds_total Request time spent in Redis, the database and JSON encoding.",
+            "# TYPE http_request_component_seconds_total counter",
+        ]
+        for (route, name), seconds in sorted(self.seconds.items()):
+            lines.append(
+                f'http_request_component_seconds_total{{route="{route}",component="{name}"}} {seconds}'
+            )
+
+        lines += [
+            "# HELP db_queries_total SQL statements run by requests.",
+            "# TYPE db_queries_total counter",
+        ]
+        for route, count in sorted(self.queries.items()):
+            lines.append(f'db_queries_total{{route="{route}"}} {count}')
+
+        lines += [
+            "# HELP db_rows_total Rows fetched or written by requests.",
+            "# TYPE db_rows_total counter",
+        ]
+        for route, count in sorted(self.rows.items()):
+            lines.append(f'db_rows_total{{route="{route}"}} {count}')
+
+        lines += [
+            "# HELP cache_lookups_total Cache lookups by key family and result (local, hit or miss).",
+            "# TYPE cache_lookups_total counter",
+        ]
+        for (family, result), count in sorted(self.cache.items()):
+            lines.append(
+                f'cache_lookups_total{{family="{family}",result="{result}"}} {count}'
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    """Collects a request's metrics, adds them to the registry and reports
+    them in a Server-Timing header. The header goes out with the start of the
+    response, for streamed responses it only covers the time until then."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        start = perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append(
+                    "Server-Timing", metrics.server_timing(perf_counter() - start)
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current.reset(token)
+            # The route template, not the path, keeps the label set bounded
+            route = scope.get("route")
+            registry.observe(
+                scope["method"],
+                route.path if route else "unmatched",
+                status,
+                perf_counter() - start,
+                metrics,
+            )
+
+
+metrics_router = APIRouter(tags=["Metrics"])
+
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def install(app: FastAPI, *engines: AsyncEngine):
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router)
+    for engine in engines:
+        event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(engine.sync_engine, "handle_error", handle_error)
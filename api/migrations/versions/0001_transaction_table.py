@@ -0,0 +1,41 @@
+"""transaction table
+
+Revision ID: 0001
+Revises:
+Create Date: 2024-11-20 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Baseline. db/01-init.sql already creates (and seeds) this table when the
+    # database container is first initialised, so it is only created here for
+    # databases that don't have it yet.
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "transaction" (
+            user_id int4 NOT NULL,
+            full_name varchar NOT NULL,
+            transaction_date timestamptz NULL,
+            transaction_amount float8 NOT NULL,
+            transaction_type varchar NOT NULL,
+            id serial4 NOT NULL,
+            CONSTRAINT transaction_pkey PRIMARY KEY (id)
+        )
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("transaction")
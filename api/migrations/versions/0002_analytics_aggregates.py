@@ -0,0 +1,96 @@
+"""analytics aggregates
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2024-11-20 10:05:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "user_transaction_summary",
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("transaction_count", sa.Integer(), nullable=False),
+        sa.Column("transaction_total", sa.Float(), nullable=False),
+        sa.Column("credit_total", sa.Float(), nullable=False),
+        sa.Column("debit_total", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    op.create_table(
+        "user_daily_transaction_summary",
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("transaction_count", sa.Integer(), nullable=False),
+        sa.Column("credit_total", sa.Float(), nullable=False),
+        sa.Column("debit_total", sa.Float(), nullable=False),
+        sa.Column("cumulative_credit_total", sa.Float(), nullable=False),
+        sa.Column("cumulative_debit_total", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id", "day"),
+    )
+    op.create_index(
+        "ix_user_daily_transaction_summary_user_id_transaction_count",
+        "user_daily_transaction_summary",
+        ["user_id", "transaction_count", "day"],
+    )
+
+    # Backfill from the existing transactions, the application keeps both
+    # tables up to date on every write from here on
+    op.execute(
+        """
+        INSERT INTO user_transaction_summary (
+            user_id, transaction_count, transaction_total, credit_total, debit_total
+        )
+        SELECT
+            user_id,
+            count(id),
+            sum(transaction_amount),
+            sum(CASE WHEN transaction_type = 'CREDIT' THEN transaction_amount ELSE 0 END),
+            sum(CASE WHEN transaction_type = 'DEBIT' THEN transaction_amount ELSE 0 END)
+        FROM "transaction"
+        GROUP BY user_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO user_daily_transaction_summary (
+            user_id, day, transaction_count, credit_total, debit_total,
+            cumulative_credit_total, cumulative_debit_total
+        )
+        SELECT
+            user_id,
+            day,
+            transaction_count,
+            credit_total,
+            debit_total,
+            sum(credit_total) OVER (PARTITION BY user_id ORDER BY day),
+            sum(debit_total) OVER (PARTITION BY user_id ORDER BY day)
+        FROM (
+            SELECT
+                user_id,
+                CAST(timezone('UTC', transaction_date) AS date) AS day,
+                count(id) AS transaction_count,
+                sum(CASE WHEN transaction_type = 'CREDIT' THEN transaction_amount ELSE 0 END) AS credit_total,
+                sum(CASE WHEN transaction_type = 'DEBIT' THEN transaction_amount ELSE 0 END) AS debit_total
+            FROM "transaction"
+            WHERE transaction_date IS NOT NULL
+            GROUP BY user_id, day
+        ) AS days
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("user_daily_transaction_summary")
+    op.drop_table("user_transaction_summary")
@@ -0,0 +1,66 @@
+"""transaction indexes
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2024-11-20 10:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built CONCURRENTLY so a large transaction table stays writable while the
+    # indexes are created, which can't happen inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_transaction_user_id_transaction_date",
+            "transaction",
+            ["user_id", "transaction_date", "id"],
+            postgresql_include=["transaction_amount", "transaction_type"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_transaction_user_id_transaction_type",
+            "transaction",
+            ["user_id", "transaction_type"],
+            postgresql_include=["transaction_amount"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.create_index(
+            "ix_transaction_transaction_date",
+            "transaction",
+            ["transaction_date", "id"],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_transaction_transaction_date",
+            "transaction",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_transaction_user_id_transaction_type",
+            "transaction",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_transaction_user_id_transaction_date",
+            "transaction",
+            postgresql_concurrently=True,
+        )
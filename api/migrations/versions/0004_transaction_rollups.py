@@ -0,0 +1,88 @@
+"""transaction rollups
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2024-11-20 10:15:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "user_daily_transaction_summary",
+        sa.Column("credit_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.add_column(
+        "user_daily_transaction_summary",
+        sa.Column("debit_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+    op.create_table(
+        "user_hourly_transaction_summary",
+        sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("hour", sa.DateTime(), nullable=False),
+        sa.Column("credit_count", sa.Integer(), nullable=False),
+        sa.Column("debit_count", sa.Integer(), nullable=False),
+        sa.Column("credit_total", sa.Float(), nullable=False),
+        sa.Column("debit_total", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("user_id", "hour"),
+    )
+
+    # Backfill from the existing transactions, the application keeps both up
+    # to date on every write from here on
+    op.execute(
+        """
+        UPDATE user_daily_transaction_summary AS summary
+        SET credit_count = days.credit_count, debit_count = days.debit_count
+        FROM (
+            SELECT
+                user_id,
+                CAST(timezone('UTC', transaction_date) AS date) AS day,
+                count(CASE WHEN transaction_type = 'CREDIT' THEN 1 END) AS credit_count,
+                count(CASE WHEN transaction_type = 'DEBIT' THEN 1 END) AS debit_count
+            FROM "transaction"
+            WHERE transaction_date IS NOT NULL
+            GROUP BY user_id, day
+        ) AS days
+        WHERE summary.user_id = days.user_id AND summary.day = days.day
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO user_hourly_transaction_summary (
+            user_id, hour, credit_count, debit_count, credit_total, debit_total
+        )
+        SELECT
+            user_id,
+            date_trunc('hour', timezone('UTC', transaction_date)) AS hour,
+            count(CASE WHEN transaction_type = 'CREDIT' THEN 1 END),
+            count(CASE WHEN transaction_type = 'DEBIT' THEN 1 END),
+            sum(CASE WHEN transaction_type = 'CREDIT' THEN transaction_amount ELSE 0 END),
+            sum(CASE WHEN transaction_type = 'DEBIT' THEN transaction_amount ELSE 0 END)
+        FROM "transaction"
+        WHERE transaction_date IS NOT NULL
+        GROUP BY user_id, hour
+        """
+    )
+    op.alter_column(
+        "user_daily_transaction_summary", "credit_count", server_default=None
+    )
+    op.alter_column(
+        "user_daily_transaction_summary", "debit_count", server_default=None
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("user_hourly_transaction_summary")
+    op.drop_column("user_daily_transaction_summary", "debit_count")
+    op.drop_column("user_daily_transaction_summary", "credit_count")
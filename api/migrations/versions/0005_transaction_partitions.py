@@ -0,0 +1,177 @@
+"""transaction partitions
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2024-11-20 10:20:00.000000
+
+"""
+from datetime import timedelta
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The default of TRANSACTION_PARTITIONS_AHEAD_MONTHS, transaction.partitions
+# creates the partitions from here on. Copied so this revision never changes.
+PARTITIONS_AHEAD_MONTHS = 3
+
+
+def create_indexes() -> None:
+    op.create_index(
+        "ix_transaction_user_id_transaction_date",
+        "transaction",
+        ["user_id", "transaction_date", "id"],
+        postgresql_include=["transaction_amount", "transaction_type"],
+    )
+    op.create_index(
+        "ix_transaction_user_id_transaction_type",
+        "transaction",
+        ["user_id", "transaction_type"],
+        postgresql_include=["transaction_amount"],
+    )
+    op.create_index(
+        "ix_transaction_transaction_date",
+        "transaction",
+        ["transaction_date", "id"],
+    )
+
+
+def drop_indexes() -> None:
+    # By name, they stay with the table when it is renamed
+    for index in (
+        "ix_transaction_transaction_date",
+        "ix_transaction_user_id_transaction_type",
+        "ix_transaction_user_id_transaction_date",
+    ):
+        op.execute(f"DROP INDEX IF EXISTS {index}")
+
+
+def upgrade() -> None:
+    connection = op.get_bind()
+
+    # The partition key has to be part of the primary key and can't be null.
+    # The API never writes a transaction without a date.
+    undated = connection.execute(
+        sa.text('SELECT count(*) FROM "transaction" WHERE transaction_date IS NULL')
+    ).scalar()
+    if undated:
+        raise RuntimeError(
+            f"{undated} transactions have no transaction_date, they have to be "
+            "given one or deleted before the table can be partitioned"
+        )
+
+    op.rename_table("transaction", "transaction_unpartitioned")
+    op.execute(
+        "ALTER TABLE transaction_unpartitioned "
+        "RENAME CONSTRAINT transaction_pkey TO transaction_unpartitioned_pkey"
+    )
+    drop_indexes()
+    op.execute("ALTER SEQUENCE transaction_id_seq OWNED BY NONE")
+
+    op.execute(
+        """
+        CREATE TABLE "transaction" (
+            user_id int4 NOT NULL,
+            full_name varchar NOT NULL,
+            transaction_date timestamptz NOT NULL,
+            transaction_amount float8 NOT NULL,
+            transaction_type varchar NOT NULL,
+            id int4 NOT NULL DEFAULT nextval('transaction_id_seq'),
+            CONSTRAINT transaction_pkey PRIMARY KEY (id, transaction_date)
+        ) PARTITION BY RANGE (transaction_date)
+        """
+    )
+    op.execute('ALTER SEQUENCE transaction_id_seq OWNED BY "transaction".id')
+
+    # A partition for every month from the oldest transaction to a few months
+    # past the newest one (or now), the default partition catches anything else
+    months = connection.execute(
+        sa.text(
+            """
+            SELECT generate_series(
+                date_trunc('month', coalesce(min(timezone('UTC', transaction_date)), timezone('UTC', now()))),
+                date_trunc('month', greatest(max(timezone('UTC', transaction_date)), timezone('UTC', now())))
+                    + make_interval(months => :ahead),
+                interval '1 month'
+            )
+            FROM transaction_unpartitioned
+            """
+        ),
+        {"ahead": PARTITIONS_AHEAD_MONTHS},
+    ).scalars()
+    for month in months:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        op.execute(
+            f"""
+            CREATE TABLE transaction_y{month:%Y}m{month:%m}
+            PARTITION OF "transaction"
+            FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{next_month:%Y-%m-%d} 00:00+00')
+            """
+        )
+    op.execute('CREATE TABLE transaction_default PARTITION OF "transaction" DEFAULT')
+
+    op.execute(
+        """
+        INSERT INTO "transaction" (
+            user_id, full_name, transaction_date, transaction_amount,
+            transaction_type, id
+        )
+        SELECT
+            user_id, full_name, transaction_date, transaction_amount,
+            transaction_type, id
+        FROM transaction_unpartitioned
+        """
+    )
+    op.drop_table("transaction_unpartitioned")
+
+    # Declared on the parent, every partition gets its own copy
+    create_indexes()
+    op.execute('ANALYZE "transaction"')
+
+
+def downgrade() -> None:
+    op.rename_table("transaction", "transaction_partitioned")
+    op.execute(
+        "ALTER TABLE transaction_partitioned "
+        "RENAME CONSTRAINT transaction_pkey TO transaction_partitioned_pkey"
+    )
+    drop_indexes()
+    op.execute("ALTER SEQUENCE transaction_id_seq OWNED BY NONE")
+
+    op.execute(
+        """
+        CREATE TABLE "transaction" (
+            user_id int4 NOT NULL,
+            full_name varchar NOT NULL,
+            transaction_date timestamptz NULL,
+            transaction_amount float8 NOT NULL,
+            transaction_type varchar NOT NULL,
+            id int4 NOT NULL DEFAULT nextval('transaction_id_seq'),
+            CONSTRAINT transaction_pkey PRIMARY KEY (id)
+        )
+        """
+    )
+    op.execute('ALTER SEQUENCE transaction_id_seq OWNED BY "transaction".id')
+    op.execute(
+        """
+        INSERT INTO "transaction" (
+            user_id, full_name, transaction_date, transaction_amount,
+            transaction_type, id
+        )
+        SELECT
+            user_id, full_name, transaction_date, transaction_amount,
+            transaction_type, id
+        FROM transaction_partitioned
+        """
+    )
+    # Detached (archived) partitions are not part of the table any more and
+    # are left alone
+    op.drop_table("transaction_partitioned")
+    create_indexes()
@@ -1,14 +1,21 @@
-import redis
+from fastapi import Request
+from redis.asyncio import Redis, BlockingConnectionPool
 from settings import settings
 
-from typing import AsyncGenerator
 
-
-async def get_client() -> AsyncGenerator[redis.Redis, None]:
-    with redis.Redis(
+def create_client() -> Redis:
+    # One pool per worker process. BlockingConnectionPool makes callers wait for
+    # a free connection instead of opening an unbounded number of them.
+    pool = BlockingConnectionPool(
         host=settings.REDIS_HOST,
         port=settings.REDIS_PORT,
         db=settings.REDIS_DB,
         protocol=settings.REDIS_PROTOCOL,
-    ) as client:
-        yield client
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT_SECONDS,
+    )
+    return Redis.from_pool(pool)
+
+
+async def get_client(request: Request) -> Redis:
+    return request.app.state.redis
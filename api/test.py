@@ -1,12 +1,37 @@
+import asyncio
 import pytest
-import redis
-from redis_client import get_client
-from json import loads
+from json import loads, dumps
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlmodel import select
 from settings import settings
 from httpx import AsyncClient
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from time import time_ns
+
+import db
+import metrics
+from transaction.aggregates import (
+    amount_sketch_query,
+    cumulative_totals_query,
+    raw_range_totals_query,
+    series_query,
+)
+from transaction.cache import (
+    REDIS_KEY_GENERATION,
+    REDIS_KEY_RECENT_WRITE,
+    REDIS_KEY_TRANSACTION,
+    REDIS_KEY_TRANSACTION_VERSION,
+    TRANSACTIONS_NOT_FOUND_TTL_SECONDS,
+)
+from transaction.enums import SeriesBucket
+from transaction.models import UserTransactionSummary
+from transaction import warmup
+from transaction.routes import busiest_day_query, transactions_page_query
 
 engine = create_async_engine(
     settings.TEST_DATABASE_URL, connect_args={"check_same_thread": False}
@@ -14,14 +39,9 @@ engine = create_async_engine(
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
-def override_get_client():
-    with redis.Redis(
-        host=settings.REDIS_HOST,
-        port=settings.REDIS_PORT,
-        db=settings.REDIS_DB,
-        protocol=settings.REDIS_PROTOCOL,
-    ) as client:
-        yield client
+async def first_page_cache_key(rc, user_id):
+    generation = await rc.get(f"generation:{user_id}")
+    return f"transactions:{user_id}:{int(generation) if generation else 0}:first"
 
 
 @pytest.fixture
@@ -53,55 +73,87 @@ async def test_invalid_transaction_type():
 
 
 @pytest.mark.asyncio
-async def test_read_transactions_no_cache():
-    async for rc in get_client():
-        for key in rc.scan_iter(match="transactions:*"):
-            rc.delete(key)
+async def test_read_transactions_no_cache(redis_client):
+    rc = redis_client
+    async for key in rc.scan_iter(match="transactions:*"):
+        await rc.delete(key)
 
-        page = 1
-        user_id = 1
+    user_id = 1
 
-        cache_data = rc.get(f"transactions:{user_id}:{page}")
-        assert cache_data == None
+    cache_data = await rc.get(await first_page_cache_key(rc, user_id))
+    assert cache_data == None
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.get(f"/core/?user_id={user_id}&page={page}")
-            response_json = response.json()
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/?user_id={user_id}")
+        response_json = response.json()
 
-        cache_data = rc.get(f"transactions:{user_id}:{page}")
-        cache_data_json = loads(cache_data)
+    cache_data = await rc.get(await first_page_cache_key(rc, user_id))
+    cache_data_json = loads(cache_data)
 
-        assert response.status_code == 200
-        assert len(cache_data_json) == len(response_json)
+    assert response.status_code == 200
+    assert len(cache_data_json["transactions"]) == len(response_json["transactions"])
 
 
 @pytest.mark.asyncio
-async def test_read_transactions_cache():
+async def test_read_transactions_cache(redis_client):
     assert 1 == 1
-    async for rc in get_client():
-        for key in rc.scan_iter(match="transactions:*"):
-            rc.delete(key)
+    rc = redis_client
+    async for key in rc.scan_iter(match="transactions:*"):
+        await rc.delete(key)
 
-        page = 1
-        user_id = 1
+    user_id = 1
+
+    # We'll first make the API call because we're assuming the request will populate the cache
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/?user_id={user_id}")
 
-        # We'll first make the API call because we're assuming the request will populate the cache
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.get(f"/core/?user_id={user_id}&page={page}")
+    cache_data = await rc.get(await first_page_cache_key(rc, user_id))
+    cache_data_json = loads(cache_data if cache_data else "{}")
 
-        cache_data = rc.get(f"transactions:{user_id}:{page}")
-        cache_data_json = loads(cache_data if cache_data else "{}")
+    # Here we're checking if the cache was actually populated
+    assert cache_data != None
 
-        # Here we're checking if the cache was actually populated
-        assert cache_data != None
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/?user_id={user_id}")
+        response_json = response.json()
+
+    # We're checking the response code and also ensuring that the data from the cache is the same as the data returned from the API call
+    assert response.status_code == 200
+    assert len(cache_data_json["transactions"]) == len(response_json["transactions"])
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.get(f"/core/?user_id={user_id}&page={page}")
-            response_json = response.json()
 
-        # We're checking the response code and also ensuring that the data from the cache is the same as the data returned from the API call
+@pytest.mark.asyncio
+async def test_read_transactions_pagination():
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get("/core/")
+        first_page = response.json()
+
         assert response.status_code == 200
-        assert len(cache_data_json) == len(response_json)
+        assert len(first_page["transactions"]) == 50
+        assert first_page["next_cursor"] != None
+
+        response = await ac.get(f"/core/?cursor={first_page['next_cursor']}")
+        second_page = response.json()
+
+    assert response.status_code == 200
+
+    first_page_ids = {x["id"] for x in first_page["transactions"]}
+    second_page_ids = {x["id"] for x in second_page["transactions"]}
+    assert first_page_ids.isdisjoint(second_page_ids)
+
+    # Pages are ordered newest first so the second page starts where the first ended
+    assert (
+        second_page["transactions"][0]["transaction_date"]
+        <= first_page["transactions"][-1]["transaction_date"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_read_transactions_invalid_cursor():
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get("/core/?cursor=not-a-cursor")
+
+    assert response.status_code == 400
 
 
 @pytest.mark.asyncio
@@ -160,61 +212,82 @@ async def test_invalid_transaction_type():
 
     assert response.status_code == 422
 
+@pytest.mark.asyncio
+async def test_create_transaction_invalidates_cache(redis_client, sample_transaction):
+    rc = redis_client
+    user_id = sample_transaction["user_id"]
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        await ac.get(f"/core/?user_id={user_id}")
+        cache_key = await first_page_cache_key(rc, user_id)
+        assert await rc.get(cache_key) != None
+
+        response = await ac.post("/core/", json=sample_transaction)
+        assert response.status_code == 200
+
+    # The write moved the user onto a new generation, the old page is never read again
+    assert await first_page_cache_key(rc, user_id) != cache_key
+    assert await rc.get(await first_page_cache_key(rc, user_id)) == None
+
+
 # Test cases for Delete Transaction
 @pytest.mark.asyncio
-async def test_delete_transaction_success():
-    async for rc in get_client():
-        for key in rc.scan_iter(match="analytics:*"):
-            rc.delete(key)
+async def test_delete_transaction_success(redis_client):
+    rc = redis_client
+    async for key in rc.scan_iter(match="analytics:*"):
+        await rc.delete(key)
 
-        for key in rc.scan_iter(match="transactions:*"):
-            rc.delete(key)
+    async for key in rc.scan_iter(match="transactions:*"):
+        await rc.delete(key)
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.post(
-                f"/core/",
-                json={
-                    "user_id": 1,
-                    "full_name": "John Doe",
-                    "transaction_date": datetime.now().isoformat(),
-                    "transaction_amount": 100.50,
-                    "transaction_type": "credit",
-                },
-            )
-        transaction_id = response.json()['id']
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.post(
+            f"/core/",
+            json={
+                "user_id": 1,
+                "full_name": "John Doe",
+                "transaction_date": datetime.now().isoformat(),
+                "transaction_amount": 100.50,
+                "transaction_type": "credit",
+            },
+        )
+    transaction_id = response.json()['id']
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.get(f"/core/{transaction_id}")
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/{transaction_id}")
 
-        # Check if data was loaded in the cache after get
-        assert rc.get(f"transaction:{transaction_id}") != None
+    # Check if data was loaded in the cache after get
+    version = int(await rc.get(REDIS_KEY_TRANSACTION_VERSION.format(transaction_id)))
+    assert await rc.get(REDIS_KEY_TRANSACTION.format(transaction_id, version)) != None
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.delete(f"/core/{transaction_id}")
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.delete(f"/core/{transaction_id}")
 
-        assert response.status_code == 204
-        assert rc.get(f"transaction:{transaction_id}") == None
+    assert response.status_code == 204
+    # The delete bumped the version, the cached body is never read again
+    version = int(await rc.get(REDIS_KEY_TRANSACTION_VERSION.format(transaction_id)))
+    assert await rc.get(REDIS_KEY_TRANSACTION.format(transaction_id, version)) == None
 
 # # Test cases for Analytics
 @pytest.mark.asyncio
-async def test_analytics_no_cache():
-    async for rc in get_client():
-        for key in rc.scan_iter(match="analytics:*"):
-            rc.delete(key)
+async def test_analytics_no_cache(redis_client):
+    rc = redis_client
+    async for key in rc.scan_iter(match="analytics:*"):
+        await rc.delete(key)
 
-        user_id = 1
+    user_id = 1
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.get(f"/core/{user_id}/analytics")
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/{user_id}/analytics")
 
-        assert response.status_code == 200
-        data = response.json()
+    assert response.status_code == 200
+    data = response.json()
 
-        assert "average_transaction_value" in data
-        assert "day_of_highest_number_of_transactions" in data
-        assert "highest_number_of_transactions_in_a_day" in data
-        assert "total_debit_value" in data
-        assert "total_credit_value" in data
+    assert "average_transaction_value" in data
+    assert "day_of_highest_number_of_transactions" in data
+    assert "highest_number_of_transactions_in_a_day" in data
+    assert "total_debit_value" in data
+    assert "total_credit_value" in data
 
 # # Test edge cases and error handling
 @pytest.mark.asyncio
@@ -235,25 +308,693 @@ async def test_analytics_no_transactions():
 
 
 @pytest.mark.asyncio
-async def test_analytics_with_date_range():
-    async for rc in get_client():
-        for key in rc.scan_iter(match="analytics:*"):
-            rc.delete(key)
+async def test_analytics_with_date_range(redis_client):
+    rc = redis_client
+    async for key in rc.scan_iter(match="analytics:*"):
+        await rc.delete(key)
+
+    base_date = datetime(2024, 1, 1)
+    user_id = 1
+
+    # Test with date range
+    start_date = base_date
+    end_date = base_date + timedelta(days=300)
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(
+            f"/core/1/analytics?transaction_value_start_date={start_date.strftime('%Y-%m-%d')}&transaction_value_end_date={end_date.strftime('%Y-%m-%d')}&user_id={user_id}"
+        )
+
+    assert response.status_code == 200
+    data = response.json()
+
+    assert data["total_debit_value"] == 14_664.27
+    assert data["total_credit_value"] == 34_404.4
+
+
+@pytest.mark.asyncio
+async def test_analytics_updated_on_create(sample_transaction):
+    user_id = 102
+    transaction = {**sample_transaction, "user_id": user_id}
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/{user_id}/analytics")
+        before = response.json()
+
+        response = await ac.post("/core/", json=transaction)
+        transaction_id = response.json()["id"]
+
+        response = await ac.get(f"/core/{user_id}/analytics")
+        after = response.json()
+
+        await ac.delete(f"/core/{transaction_id}")
+
+        response = await ac.get(f"/core/{user_id}/analytics")
+        after_delete = response.json()
+
+    assert after["total_credit_value"] == round(
+        before["total_credit_value"] + transaction["transaction_amount"], 2
+    )
+    assert after["total_debit_value"] == before["total_debit_value"]
+    assert after_delete == before
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+@pytest.mark.asyncio
+async def test_analytics_recomputed_after_write(redis_client, sample_transaction):
+    rc = redis_client
+    user_id = 105
+    start = datetime(2024, 1, 1, 12)
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        # Remembered, the write recomputes this range along with the default one
+        await ac.get(
+            f"/core/{user_id}/analytics",
+            params={"transaction_value_start_date": start.isoformat()},
+        )
+        await ac.post("/core/", json={**sample_transaction, "user_id": user_id})
+
+    generation = int(await rc.get(f"generation:{user_id}"))
+    key = f"analytics:{user_id}:{generation}:average_transaction_value"
+    range_key = f"analytics:{user_id}:{generation}:total_credit_value:{start}:all"
+    for _ in range(50):
+        if await rc.get(key) and await rc.get(range_key):
+            break
+        await asyncio.sleep(0.1)
+
+    assert float(await rc.get(key)) == sample_transaction["transaction_amount"]
+    assert await rc.get(range_key) is not None
+
+
+@pytest.mark.asyncio
+async def test_read_transactions_by_id(redis_client):
+    rc = redis_client
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get("/core/batch?ids=2&ids=999999&ids=1")
+        transactions = response.json()["transactions"]
+
+        assert response.status_code == 200
+        assert [transaction and transaction["id"] for transaction in transactions] == [
+            2,
+            None,
+            1,
+        ]
+        version = int(await rc.get(REDIS_KEY_TRANSACTION_VERSION.format(999999)))
+        assert await rc.get(REDIS_KEY_TRANSACTION.format(999999, version)) == b"null"
+
+        # Read alone the null is cached as briefly, bulk inserts don't bump the
+        # version of the ids they create
+        await ac.get("/core/999998")
+        version = int(await rc.get(REDIS_KEY_TRANSACTION_VERSION.format(999998)))
+        key = REDIS_KEY_TRANSACTION.format(999998, version)
+        assert 0 < await rc.ttl(key) <= TRANSACTIONS_NOT_FOUND_TTL_SECONDS
+
+        response = await ac.get("/core/1")
+
+    assert transactions[2] == response.json()
+
+
+@pytest.mark.asyncio
+async def test_batch_analytics():
+    user_ids = [1, 2, 1, 999999]
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.post("/core/analytics/batch", json={"user_ids": user_ids})
+        rows = {row.pop("user_id"): row for row in map(loads, response.text.splitlines())}
+
+        assert response.status_code == 200
+        assert sorted(rows) == [1, 2, 999999]
+        assert rows[999999]["highest_number_of_transactions_in_a_day"] == 0
+
+        response = await ac.get("/core/1/analytics")
+
+    assert rows[1] == response.json()
+
+
+@pytest.mark.asyncio
+async def test_metrics():
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get("/core/1/analytics")
+        assert "redis;dur=" in response.headers["server-timing"]
+
+        response = await ac.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'route="/core/{user_id}/analytics"' in response.text
+    assert "cache_lookups_total" in response.text
+
+
+@pytest.mark.asyncio
+async def test_metrics_of_failed_query():
+    engine = create_async_engine(db.engine.url, poolclass=NullPool)
+    for name in ("before_cursor_execute", "after_cursor_execute", "handle_error"):
+        event.listen(engine.sync_engine, name, getattr(metrics, name))
+    request_metrics = metrics.RequestMetrics()
+    token = metrics.current.set(request_metrics)
+
+    async with engine.connect() as conn:
+        with pytest.raises(DBAPIError):
+            await conn.execute(text("SELECT 1 / 0"))
+        await conn.rollback()
+        # Nothing left behind for the connection's next statement
+        assert not conn.sync_connection.info["query_start"]
 
-        base_date = datetime(2024, 1, 1)
-        user_id = 1
+        await conn.execute(text("SELECT generate_series(1, 3)"))
 
-        # Test with date range
-        start_date = base_date
-        end_date = base_date + timedelta(days=300)
+    metrics.current.reset(token)
+    await engine.dispose()
 
-        async with AsyncClient(base_url="http://localhost:8000") as ac:
-            response = await ac.get(
-                f"/core/1/analytics?transaction_value_start_date={start_date.strftime('%Y-%m-%d')}&transaction_value_end_date={end_date.strftime('%Y-%m-%d')}&user_id={user_id}"
+    assert request_metrics.queries == 1
+    assert request_metrics.rows == 3
+    assert request_metrics.seconds["db"] > 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_analytics_requests(redis_client, sample_transaction):
+    rc = redis_client
+    user_id = 104
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        await ac.post("/core/", json={**sample_transaction, "user_id": user_id})
+
+        responses = await asyncio.gather(
+            *[ac.get(f"/core/{user_id}/analytics") for _ in range(20)]
+        )
+
+    assert all(response.status_code == 200 for response in responses)
+    assert len({response.text for response in responses}) == 1
+    assert not await rc.keys("lock:*")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_create_transactions(sample_transaction):
+    user_id = 107
+    amounts = [float(amount) for amount in range(1, 21)]
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        before = (await ac.get(f"/core/{user_id}/analytics")).json()
+        responses = await asyncio.gather(
+            *[
+                ac.post(
+                    "/core/",
+                    json={
+                        **sample_transaction,
+                        "user_id": user_id,
+                        "transaction_amount": amount,
+                    },
+                )
+                for amount in amounts
+            ]
+        )
+        analytics = await ac.get(f"/core/{user_id}/analytics")
+
+    # Batched or not, every caller gets its own row back
+    transactions = [response.json() for response in responses]
+    assert [transaction["transaction_amount"] for transaction in transactions] == amounts
+    assert len({transaction["id"] for transaction in transactions}) == len(amounts)
+    assert analytics.json()["total_credit_value"] == pytest.approx(
+        before["total_credit_value"] + sum(amounts)
+    )
+
+
+@pytest.mark.asyncio
+async def test_concurrent_delete_transaction(sample_transaction):
+    user_id = 109
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        before = (await ac.get(f"/core/{user_id}/analytics")).json()
+        response = await ac.post(
+            "/core/", json={**sample_transaction, "user_id": user_id}
+        )
+        id = response.json()["id"]
+
+        responses = await asyncio.gather(
+            ac.delete(f"/core/{id}"), ac.delete(f"/core/{id}")
+        )
+        after = (await ac.get(f"/core/{user_id}/analytics")).json()
+
+    # Only one of them deletes the row and takes it out of the aggregates
+    assert sorted(response.status_code for response in responses) == [204, 404]
+    assert after["total_credit_value"] == pytest.approx(before["total_credit_value"])
+    assert after["average_transaction_value"] == pytest.approx(
+        before["average_transaction_value"]
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not settings.DATABASE_REPLICA_URLS, reason="No read replicas configured"
+)
+async def test_read_your_writes(redis_client, sample_transaction):
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.post("/core/", json=sample_transaction)
+        assert response.cookies.get(db.READ_PRIMARY_COOKIE)
+
+        # Read from the primary, whatever the lag of the replicas
+        transaction = await ac.get(f"/core/{response.json()['id']}")
+
+    assert transaction.json()["id"] == response.json()["id"]
+    # Whoever reads the user's new generation meanwhile reads the primary too
+    assert await redis_client.exists(
+        REDIS_KEY_RECENT_WRITE.format(
+            REDIS_KEY_GENERATION.format(sample_transaction["user_id"])
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_use_primary():
+    primary = create_async_engine(db.engine.url, poolclass=NullPool)
+    replica = create_async_engine(db.engine.url, poolclass=NullPool)
+    replicas = db.ReplicaRouter([replica], primary, retry_after=60)
+
+    async with replicas.session() as session:
+        await session.exec(select(1))
+        assert session.sync_session.read_bind is replica.sync_engine
+
+        await db.use_primary(session)
+        assert (await session.exec(select(1))).one() == 1
+        assert session.sync_session.read_bind is primary.sync_engine
+
+    await primary.dispose()
+    await replica.dispose()
+
+
+@pytest.mark.asyncio
+async def test_unavailable_replica_falls_back_to_primary():
+    primary = create_async_engine(db.engine.url, poolclass=NullPool)
+    unavailable = create_async_engine(primary.url.set(port=1), poolclass=NullPool)
+    replicas = db.ReplicaRouter([unavailable], primary, retry_after=60)
+
+    async with replicas.session() as session:
+        assert (await session.exec(select(1))).one() == 1
+        assert session.sync_session.read_bind is primary.sync_engine
+    # Not tried again until retry_after has passed
+    assert replicas.down_until[0] > 0
+
+    await primary.dispose()
+    await unavailable.dispose()
+
+
+@pytest.mark.asyncio
+async def test_analytics_percentiles(sample_transaction):
+    # A user of its own on every run, percentiles can't be compared before and
+    # after like totals
+    user_id = 1_000_000 + time_ns() % 1_000_000
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        await ac.post(
+            "/core/bulk",
+            json=[
+                {**sample_transaction, "user_id": user_id, "transaction_amount": amount}
+                for amount in range(1, 101)
+            ],
+        )
+        response = await ac.get(f"/core/{user_id}/analytics/percentiles")
+        everyone = await ac.get("/core/analytics/percentiles")
+
+    assert response.status_code == 200
+    percentiles = response.json()
+    assert percentiles["transaction_count"] == 100
+    # Within the 1% accuracy of the sketches
+    assert percentiles["median"] == pytest.approx(50, rel=0.01)
+    assert percentiles["p90"] == pytest.approx(90, rel=0.01)
+    assert percentiles["p99"] == pytest.approx(99, rel=0.01)
+
+    assert everyone.status_code == 200
+    assert everyone.json()["transaction_count"] >= 100
+
+
+@pytest.mark.asyncio
+async def test_conditional_requests(sample_transaction):
+    user_id = 108
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.post("/core/", json={**sample_transaction, "user_id": user_id})
+        transaction_id = response.json()["id"]
+        urls = [
+            f"/core/{transaction_id}",
+            f"/core/?user_id={user_id}",
+            f"/core/{user_id}/analytics",
+        ]
+        etags = [(await ac.get(url)).headers["etag"] for url in urls]
+
+        unchanged = [
+            await ac.get(url, headers={"If-None-Match": etag})
+            for url, etag in zip(urls, etags)
+        ]
+        # "*" matches any version of a resource that exists
+        any_version = [
+            await ac.get(url, headers={"If-None-Match": "*"}) for url in urls
+        ]
+        missing = await ac.get("/core/999997", headers={"If-None-Match": "*"})
+
+        await ac.put(
+            f"/core/{transaction_id}",
+            json={**sample_transaction, "user_id": user_id, "transaction_amount": 1.0},
+        )
+        changed = [
+            await ac.get(url, headers={"If-None-Match": etag})
+            for url, etag in zip(urls, etags)
+        ]
+
+    assert [response.status_code for response in unchanged] == [304, 304, 304]
+    assert [response.content for response in unchanged] == [b"", b"", b""]
+    assert [response.status_code for response in any_version] == [304, 304, 304]
+    assert missing.status_code == 200
+    assert missing.json() is None
+    assert [response.status_code for response in changed] == [200, 200, 200]
+    assert all(
+        response.headers["etag"] != etag for response, etag in zip(changed, etags)
+    )
+    assert changed[0].json()["transaction_amount"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_cache_warmup(redis_client, monkeypatch):
+    rc = redis_client
+    # Long enough ago to cover the sample data
+    monkeypatch.setattr(settings, "CACHE_WARMUP_USERS", 3)
+    monkeypatch.setattr(settings, "CACHE_WARMUP_DAYS", 10_000)
+
+    async with db.async_session() as session:
+        results = await session.exec(warmup.most_active_users_query(3, 10_000))
+        user_ids = results.all()
+
+    await warmup.run(rc)
+    await db.engine.dispose()
+
+    assert len(user_ids) == 3
+    for user_id in [*user_ids, "all"]:
+        assert await rc.get(await first_page_cache_key(rc, user_id)) != None
+    assert await rc.keys(f"analytics:{user_ids[0]}:*")
+
+
+@pytest.mark.asyncio
+async def test_analytics_series(sample_transaction):
+    user_id = 106
+    transaction_dates = ["2024-03-04T10:15:00+00:00", "2024-03-04T10:45:00+00:00"]
+    hour_range = {"start_date": "2024-03-04T10:30:00", "end_date": "2024-03-04T12:00:00"}
+
+    async def series(ac, **params) -> dict:
+        response = await ac.get(f"/core/{user_id}/analytics/series", params=params)
+        assert response.status_code == 200
+        return {bucket["start"]: bucket for bucket in response.json()["series"]}
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        hours_before = await series(ac, bucket="hour", **hour_range)
+        months_before = await series(ac, bucket="month")
+
+        for transaction_date in [*transaction_dates, "2024-03-20T08:00:00+00:00"]:
+            await ac.post(
+                "/core/",
+                json={
+                    **sample_transaction,
+                    "user_id": user_id,
+                    "transaction_date": transaction_date,
+                },
             )
 
+        hours = await series(ac, bucket="hour", **hour_range)
+        months = await series(ac, bucket="month")
+
+    # The range is widened to the whole hour the start falls in
+    hour = "2024-03-04T10:00:00+00:00"
+    assert list(hours) == [hour]
+    assert hours[hour]["credit_count"] == 2 + hours_before.get(hour, {}).get(
+        "credit_count", 0
+    )
+    assert hours[hour]["average_credit_value"] == sample_transaction["transaction_amount"]
+
+    month = "2024-03-01T00:00:00+00:00"
+    assert list(months) == [month]
+    assert months[month]["transaction_count"] == 3 + months_before.get(
+        month, {}
+    ).get("transaction_count", 0)
+    assert months[month]["debit_count"] == 0
+
+
+# Rows for the users the tests query, the first hundred, inserted, analyzed
+# and rolled back around each EXPLAIN. On the seed data alone a user has a
+# handful of rows, and which of the indexes on them the planner picks is
+# down to the visibility map and the indexes' sizes
+PLANNER_VOLUME = {
+    "transaction": """
+    INSERT INTO transaction (id, user_id, full_name, transaction_date,
+        transaction_amount, transaction_type)
+    SELECT -n, 1 + n % 100, 'Volume',
+        timestamptz '2023-06-01 UTC' + n * interval '10 minutes', n % 997,
+        CASE WHEN n % 3 = 0 THEN 'DEBIT' ELSE 'CREDIT' END
+    FROM generate_series(1, 200000) n
+    """,
+    "user_daily_transaction_summary": """
+    INSERT INTO user_daily_transaction_summary
+    SELECT 1 + n % 100, date '2023-06-01' + n / 100, n % 7, 0, 0, 0, 0, 0, 0
+    FROM generate_series(0, 199999) n
+    ON CONFLICT DO NOTHING
+    """,
+    "user_hourly_transaction_summary": """
+    INSERT INTO user_hourly_transaction_summary
+    SELECT 1 + n % 100, timestamp '2024-05-01' + n / 100 * interval '1 hour',
+        0, 0, 0, 0
+    FROM generate_series(0, 199999) n
+    ON CONFLICT DO NOTHING
+    """,
+    "user_transaction_summary": """
+    INSERT INTO user_transaction_summary
+    SELECT n, 0, 0, 0, 0 FROM generate_series(1, 200000) n
+    ON CONFLICT DO NOTHING
+    """,
+    "user_daily_amount_sketch": """
+    INSERT INTO user_daily_amount_sketch
+    SELECT 1 + n % 100, date '2024-01-01' + n / 1000, n / 100 % 10, 1
+    FROM generate_series(0, 199999) n
+    ON CONFLICT DO NOTHING
+    """,
+    "daily_amount_sketch": """
+    INSERT INTO daily_amount_sketch
+    SELECT date '2020-01-01' + n / 100, n % 100 / 16, n % 16, 1
+    FROM generate_series(0, 199999) n
+    ON CONFLICT DO NOTHING
+    """,
+}
+
+
+async def explain(query) -> dict:
+    sql = query.compile(
+        dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    tables = [table.name for table in query.get_final_froms()]
+
+    # Not the application's pooled engine, pooled connections stay bound to
+    # the event loop of the test that opened them
+    engine = create_async_engine(db.engine.url, poolclass=NullPool)
+    async with engine.connect() as conn:
+        for table in tables:
+            await conn.execute(text(PLANNER_VOLUME[table]))
+            await conn.execute(text(f"ANALYZE {table}"))
+        result = await conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))
+        plan = result.scalar()[0]["Plan"]
+        await conn.rollback()
+
+        # The statistics roll back, the row counts ANALYZE keeps in pg_class
+        # don't
+        for table in tables:
+            await conn.execute(text(f"ANALYZE {table}"))
+        await conn.commit()
+    await engine.dispose()
+
+    return plan
+
+
+async def scanned_indexes(plan) -> list[str]:
+    """The indexes the plan scans, as the index declared on the table for the
+    partitions' own indexes."""
+
+    names = [node["Index Name"] for node in plan_nodes(plan) if "Index Name" in node]
+
+    engine = create_async_engine(db.engine.url, poolclass=NullPool)
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            text(
+                """
+                SELECT index.relname, coalesce(parent.relname, index.relname)
+                FROM pg_class index
+                LEFT JOIN pg_inherits ON pg_inherits.inhrelid = index.oid
+                LEFT JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                WHERE index.relname = ANY(:names)
+                """
+            ),
+            {"names": names},
+        )
+        indexes = dict(result.all())
+    await engine.dispose()
+
+    return [indexes[name] for name in names]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (
+            transactions_page_query(1, None, None),
+            "ix_transaction_user_id_transaction_date",
+        ),
+        # Mid month, at the start of a partition only a few rows are before
+        # the cursor and the date index is as good
+        (
+            transactions_page_query(1, datetime(2024, 6, 15, tzinfo=timezone.utc), 500),
+            "ix_transaction_user_id_transaction_date",
+        ),
+        (
+            transactions_page_query(
+                None, datetime(2024, 6, 1, tzinfo=timezone.utc), 500
+            ),
+            "ix_transaction_transaction_date",
+        ),
+        (
+            busiest_day_query(1),
+            "ix_user_daily_transaction_summary_user_id_transaction_count",
+        ),
+        (
+            cumulative_totals_query(1, datetime(2024, 6, 1).date()),
+            "user_daily_transaction_summary_pkey",
+        ),
+        (
+            raw_range_totals_query(
+                1,
+                datetime(2024, 6, 1, 12, tzinfo=timezone.utc),
+                datetime(2024, 6, 2, tzinfo=timezone.utc),
+            ),
+            "ix_transaction_user_id_transaction_date",
+        ),
+        (
+            select(UserTransactionSummary).where(UserTransactionSummary.user_id == 1),
+            "user_transaction_summary_pkey",
+        ),
+        (
+            series_query(
+                1, SeriesBucket.HOUR, datetime(2024, 6, 1), datetime(2024, 6, 2)
+            ),
+            "user_hourly_transaction_summary_pkey",
+        ),
+        (
+            series_query(1, SeriesBucket.MONTH, datetime(2024, 1, 1), None),
+            "user_daily_transaction_summary_pkey",
+        ),
+        (
+            amount_sketch_query(1, datetime(2024, 1, 1), datetime(2024, 6, 30)),
+            "user_daily_amount_sketch_pkey",
+        ),
+        (
+            amount_sketch_query(None, datetime(2024, 1, 1), datetime(2024, 6, 30)),
+            "daily_amount_sketch_pkey",
+        ),
+    ],
+)
+async def test_queries_use_indexes(query, index):
+    plan = await explain(query)
+
+    scans = [node for node in plan_nodes(plan) if "Relation Name" in node]
+    assert scans
+    assert all(node["Node Type"] != "Seq Scan" for node in scans)
+
+    indexes = await scanned_indexes(plan)
+    assert all(parent == index for parent in indexes)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query, partitions",
+    [
+        (
+            raw_range_totals_query(
+                1,
+                datetime(2024, 6, 1, 12, tzinfo=timezone.utc),
+                datetime(2024, 6, 2, tzinfo=timezone.utc),
+            ),
+            {"transaction_y2024m06"},
+        ),
+        # A page after a cursor only reads the months up to the cursor's, and
+        # the default partition for dates before the first month
+        (
+            transactions_page_query(1, datetime(2024, 6, 1, tzinfo=timezone.utc), 500),
+            {f"transaction_y2024m{month:02}" for month in range(1, 7)}
+            | {"transaction_default"},
+        ),
+    ],
+)
+async def test_queries_prune_partitions(query, partitions):
+    plan = await explain(query)
+
+    scanned = {
+        node["Relation Name"] for node in plan_nodes(plan) if "Relation Name" in node
+    }
+    assert scanned == partitions
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_transactions(sample_transaction):
+    user_id = 103
+    transactions = [{**sample_transaction, "user_id": user_id}] * 3
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/{user_id}/analytics")
+        before = response.json()
+
+        response = await ac.post("/core/bulk", json=transactions)
+        assert response.status_code == 200
+        assert response.json() == {"inserted": 3}
+
+        response = await ac.post(
+            "/core/bulk",
+            content="\n".join(dumps(x) for x in transactions),
+            headers={"content-type": "application/x-ndjson"},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"inserted": 3}
+
+        response = await ac.get(f"/core/{user_id}/analytics")
+        after = response.json()
+
+    assert after["total_credit_value"] == round(
+        before["total_credit_value"] + 6 * sample_transaction["transaction_amount"], 2
+    )
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_transactions_invalid_row(sample_transaction):
+    transactions = [sample_transaction, {**sample_transaction, "transaction_type": "x"}]
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.post("/core/bulk", json=transactions)
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", 1, "transaction_type"]
+
+
+@pytest.mark.asyncio
+async def test_export_transactions():
+    user_id = 1
+
+    async with AsyncClient(base_url="http://localhost:8000") as ac:
+        response = await ac.get(f"/core/export?user_id={user_id}")
+        rows = [loads(line) for line in response.text.splitlines()]
+
         assert response.status_code == 200
-        data = response.json()
+        assert rows
+        assert all(row["user_id"] == user_id for row in rows)
+
+        response = await ac.get(f"/core/export?user_id={user_id}&format=csv")
+        lines = response.text.splitlines()
 
-        assert data["total_debit_value"] == 14_664.27
-        assert data["total_credit_value"] == 34_404.4
+    assert response.status_code == 200
+    assert lines[0] == "id,user_id,full_name,transaction_date,transaction_amount,transaction_type"
+    assert len(lines) == len(rows) + 1
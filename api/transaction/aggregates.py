@@ -0,0 +1,798 @@
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterable
+
+from sqlalchemy import (
+    Date,
+    cast,
+    delete,
+    false,
+    insert,
+    literal_column,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import select, func, case
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from transaction.enums import SeriesBucket, TransactionType
+from transaction.models import (
+    DailyAmountSketch,
+    Transaction,
+    TransactionBase,
+    UserDailyAmountSketch,
+    UserDailyTransactionSummary,
+    UserHourlyTransactionSummary,
+    UserTransactionSummary,
+)
+from transaction.sketch import AmountSketch, amount_bucket
+
+# The amounts percentiles are given for
+AMOUNT_PERCENTILES = {"median": 0.5, "p90": 0.9, "p99": 0.99}
+
+# Rows per day and bucket of daily_amount_sketch, concurrent writes only wait
+# on each other when their users fall in the same shard
+AMOUNT_SKETCH_SHARDS = 16
+
+
+def amount_sketch_shard(user_id: int) -> int:
+    return user_id % AMOUNT_SKETCH_SHARDS
+
+
+def as_utc(value: datetime) -> datetime:
+    # Naive datetimes (e.g. dates passed in query strings) are taken to be UTC
+    if value.tzinfo:
+        return value.astimezone(timezone.utc)
+    return value.replace(tzinfo=timezone.utc)
+
+
+def transaction_day(transaction_date: datetime) -> date:
+    # Days are always bucketed in UTC so the aggregates don't depend on the
+    # timezone of whichever connection wrote them
+    return as_utc(transaction_date).date()
+
+
+def transaction_hour(transaction_date: datetime) -> datetime:
+    # Stored without a timezone, always UTC
+    return as_utc(transaction_date).replace(
+        minute=0, second=0, microsecond=0, tzinfo=None
+    )
+
+
+def start_of_day(day: date) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+def transaction_day_column(session: AsyncSession):
+    if session.bind.dialect.name == "postgresql":
+        return cast(func.timezone("UTC", Transaction.transaction_date), Date)
+    return func.date(Transaction.transaction_date)
+
+
+def transaction_hour_column(session: AsyncSession):
+    if session.bind.dialect.name == "postgresql":
+        return func.date_trunc(
+            "hour", func.timezone("UTC", Transaction.transaction_date)
+        )
+    # The format SQLAlchemy stores datetimes in on SQLite
+    return func.strftime("%Y-%m-%d %H:00:00.000000", Transaction.transaction_date)
+
+
+def amount_of_type(transaction_type: TransactionType):
+    return case(
+        (
+            Transaction.transaction_type == transaction_type,
+            Transaction.transaction_amount,
+        ),
+        else_=0,
+    )
+
+
+def count_of_type(transaction_type: TransactionType):
+    return func.count(case((Transaction.transaction_type == transaction_type, 1)))
+
+
+def upsert(session: AsyncSession, model):
+    if session.bind.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def increment(session: AsyncSession, model, keys: list[str], rows: list[dict]):
+    if not rows:
+        return
+
+    statement = upsert(session, model)
+    columns = [column for column in rows[0] if column not in keys]
+    statement = statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={
+            column: getattr(model, column) + getattr(statement.excluded, column)
+            for column in columns
+        },
+    )
+    await session.exec(statement, params=rows)
+
+
+def cumulative_totals_query(user_id: int, day: date):
+    return (
+        select(
+            UserDailyTransactionSummary.cumulative_credit_total,
+            UserDailyTransactionSummary.cumulative_debit_total,
+        )
+        .where(
+            UserDailyTransactionSummary.user_id == user_id,
+            UserDailyTransactionSummary.day <= day,
+        )
+        .order_by(UserDailyTransactionSummary.day.desc())
+        .limit(1)
+    )
+
+
+async def cumulative_totals(
+    session: AsyncSession, user_id: int, day: date
+) -> tuple[float, float]:
+    """Credit and debit totals of every transaction up to the end of `day`."""
+
+    results = await session.exec(cumulative_totals_query(user_id, day))
+    if query_results := results.first():
+        return tuple(query_results)
+    return 0, 0
+
+
+async def recompute_cumulative_totals(
+    session: AsyncSession, user_id: int, from_day: date
+):
+    # Running totals before from_day are untouched, everything from it onwards
+    # is the last untouched running total plus a running sum of the day totals
+    credit_before, debit_before = await cumulative_totals(
+        session, user_id, from_day - timedelta(days=1)
+    )
+    days = (
+        select(
+            UserDailyTransactionSummary.day,
+            func.sum(UserDailyTransactionSummary.credit_total)
+            .over(order_by=UserDailyTransactionSummary.day)
+            .label("credit_total"),
+            func.sum(UserDailyTransactionSummary.debit_total)
+            .over(order_by=UserDailyTransactionSummary.day)
+            .label("debit_total"),
+        )
+        .where(
+            UserDailyTransactionSummary.user_id == user_id,
+            UserDailyTransactionSummary.day >= from_day,
+        )
+        .subquery()
+    )
+    await session.exec(
+        update(UserDailyTransactionSummary)
+        .where(
+            UserDailyTransactionSummary.user_id == user_id,
+            UserDailyTransactionSummary.day == days.c.day,
+        )
+        .values(
+            cumulative_credit_total=days.c.credit_total + credit_before,
+            cumulative_debit_total=days.c.debit_total + debit_before,
+        )
+    )
+
+
+class AggregateDeltas:
+    """Accumulates the effect of added and removed transactions on the
+    aggregates so a whole batch of writes is applied in one go. An update is a
+    remove of the old values plus an add of the new ones."""
+
+    def __init__(self):
+        self.summaries = defaultdict(lambda: defaultdict(float))
+        self.daily = defaultdict(lambda: defaultdict(float))
+        self.hourly = defaultdict(lambda: defaultdict(float))
+        self.sketches = defaultdict(int)
+
+    def add(self, transaction: TransactionBase, sign: int = 1):
+        amount = sign * transaction.transaction_amount
+        is_credit = transaction.transaction_type == TransactionType.CREDIT
+        credit = amount if is_credit else 0
+        debit = 0 if is_credit else amount
+        rollup = {
+            "credit_count": sign if is_credit else 0,
+            "debit_count": 0 if is_credit else sign,
+            "credit_total": credit,
+            "debit_total": debit,
+        }
+
+        summary = self.summaries[transaction.user_id]
+        summary["transaction_count"] += sign
+        summary["transaction_total"] += amount
+        summary["credit_total"] += credit
+        summary["debit_total"] += debit
+
+        day = self.daily[
+            (transaction.user_id, transaction_day(transaction.transaction_date))
+        ]
+        day["transaction_count"] += sign
+        hour = self.hourly[
+            (transaction.user_id, transaction_hour(transaction.transaction_date))
+        ]
+        for column, value in rollup.items():
+            day[column] += value
+            hour[column] += value
+
+        self.sketches[
+            (
+                transaction.user_id,
+                transaction_day(transaction.transaction_date),
+                amount_bucket(transaction.transaction_amount),
+            )
+        ] += sign
+
+    def remove(self, transaction: TransactionBase):
+        self.add(transaction, sign=-1)
+
+    @property
+    def user_ids(self) -> set[int]:
+        return set(self.summaries)
+
+    async def apply(self, session: AsyncSession):
+        """Must run in the same session (and so the same database transaction)
+        as the writes it accounts for."""
+
+        # The summary rows are upserted first and in user_id order. Their row
+        # locks are held until commit, which serialises concurrent writers of
+        # the same user for the running totals below without deadlocking on
+        # writes that touch several users.
+        await increment(
+            session,
+            UserTransactionSummary,
+            ["user_id"],
+            [
+                {"user_id": user_id, **self.summaries[user_id]}
+                for user_id in sorted(self.summaries)
+            ],
+        )
+        await increment(
+            session,
+            UserDailyTransactionSummary,
+            ["user_id", "day"],
+            [
+                {"user_id": user_id, "day": day, **totals}
+                for (user_id, day), totals in sorted(self.daily.items())
+            ],
+        )
+        await increment(
+            session,
+            UserHourlyTransactionSummary,
+            ["user_id", "hour"],
+            [
+                {"user_id": user_id, "hour": hour, **totals}
+                for (user_id, hour), totals in sorted(self.hourly.items())
+            ],
+        )
+
+        # The rows across every user are shared by the writers of users in the
+        # same shard, in (day, bucket, shard) order so concurrent writers wait
+        # on each other instead of deadlocking
+        sketches = [item for item in sorted(self.sketches.items()) if item[1]]
+        everyone = defaultdict(int)
+        for (user_id, day, bucket), count in sketches:
+            everyone[(day, bucket, amount_sketch_shard(user_id))] += count
+        await increment(
+            session,
+            UserDailyAmountSketch,
+            ["user_id", "day", "bucket"],
+            [
+                {
+                    "user_id": user_id,
+                    "day": day,
+                    "bucket": bucket,
+                    "transaction_count": count,
+                }
+                for (user_id, day, bucket), count in sketches
+            ],
+        )
+        await increment(
+            session,
+            DailyAmountSketch,
+            ["day", "bucket", "shard"],
+            [
+                {
+                    "day": day,
+                    "bucket": bucket,
+                    "shard": shard,
+                    "transaction_count": count,
+                }
+                for (day, bucket, shard), count in sorted(everyone.items())
+                if count
+            ],
+        )
+
+        first_days = {}
+        for user_id, day in self.daily:
+            first_days[user_id] = min(day, first_days.get(user_id, day))
+
+        # Most writes land on a user's latest day, so there is a single row to
+        # recompute
+        for user_id, day in sorted(first_days.items()):
+            await recompute_cumulative_totals(session, user_id, day)
+
+
+async def update_aggregates(
+    session: AsyncSession,
+    added: Iterable[TransactionBase] = (),
+    removed: Iterable[TransactionBase] = (),
+):
+    """Apply the effect of added and removed transactions to the running
+    aggregates, in the same database transaction as the write."""
+
+    deltas = AggregateDeltas()
+    for transaction in added:
+        deltas.add(transaction)
+    for transaction in removed:
+        deltas.remove(transaction)
+    await deltas.apply(session)
+
+
+def raw_range_totals_query(
+    user_id: int, start: datetime, end: datetime, end_inclusive: bool = True
+):
+    return select(
+        func.coalesce(func.sum(amount_of_type(TransactionType.CREDIT)), 0),
+        func.coalesce(func.sum(amount_of_type(TransactionType.DEBIT)), 0),
+    ).where(
+        Transaction.user_id == user_id,
+        Transaction.transaction_date >= start,
+        (
+            Transaction.transaction_date <= end
+            if end_inclusive
+            else Transaction.transaction_date < end
+        ),
+    )
+
+
+def signed_totals(query, sign: int = 1):
+    credit, debit = query.subquery().c
+    return select(
+        (sign * credit).label("credit_total"), (sign * debit).label("debit_total")
+    )
+
+
+def split_range(
+    start: datetime | None, end: datetime | None
+) -> tuple[list[tuple[datetime, datetime, bool]], tuple[date | None, date] | None]:
+    """Split the range from start to end (both inclusive, either can be left
+    open) into the partial days at either edge, as (start, end, end_inclusive)
+    to be summed from the transaction table, and the whole days in between as
+    (first, last), None if there are none. first is None for an open start."""
+
+    start = as_utc(start) if start else None
+    end = as_utc(end) if end else None
+
+    if start and end:
+        if start > end:
+            return [], None
+        if start.date() == end.date():
+            return [(start, end, True)], None
+
+    edges = []
+
+    first_full_day = None
+    if start:
+        first_full_day = start.date()
+        if start != start_of_day(first_full_day):
+            first_full_day += timedelta(days=1)
+            edges.append((start, start_of_day(first_full_day), False))
+
+    last_full_day = date.max
+    if end:
+        last_full_day = end.date() - timedelta(days=1)
+        edges.append((start_of_day(end.date()), end, True))
+
+    if first_full_day and first_full_day > last_full_day:
+        return edges, None
+    return edges, (first_full_day, last_full_day)
+
+
+def range_totals_query(user_id: int, start: datetime | None, end: datetime | None):
+    """Credit and debit totals of transactions between start and end (both
+    inclusive, either can be left open), as a single row. Whole days come from
+    two lookups on the running totals, only the partial days at either edge
+    are summed from the transaction table."""
+
+    edges, full_days = split_range(start, end)
+
+    parts = [signed_totals(raw_range_totals_query(user_id, *edge)) for edge in edges]
+    if full_days:
+        first_full_day, last_full_day = full_days
+        parts.append(signed_totals(cumulative_totals_query(user_id, last_full_day)))
+        if first_full_day:
+            parts.append(
+                signed_totals(
+                    cumulative_totals_query(
+                        user_id, first_full_day - timedelta(days=1)
+                    ),
+                    sign=-1,
+                )
+            )
+
+    if not parts:
+        return select(
+            literal_column("0").label("credit_total"),
+            literal_column("0").label("debit_total"),
+        )
+
+    # The running total lookups return no row when there is nothing before
+    # the day, which the sum treats as zero
+    totals = union_all(*parts).subquery()
+    return select(
+        func.coalesce(func.sum(totals.c.credit_total), 0).label("credit_total"),
+        func.coalesce(func.sum(totals.c.debit_total), 0).label("debit_total"),
+    )
+
+
+def range_totals_by_user_query(
+    user_ids: list[int], start: datetime | None, end: datetime | None
+):
+    """Credit and debit totals between start and end like range_totals_query,
+    for many users at once, one row per user that has any. Whole days are
+    summed from the daily totals."""
+
+    edges, full_days = split_range(start, end)
+
+    parts = [
+        select(
+            Transaction.user_id.label("user_id"),
+            func.sum(amount_of_type(TransactionType.CREDIT)).label("credit_total"),
+            func.sum(amount_of_type(TransactionType.DEBIT)).label("debit_total"),
+        )
+        .where(
+            Transaction.user_id.in_(user_ids),
+            Transaction.transaction_date >= edge_start,
+            (
+                Transaction.transaction_date <= edge_end
+                if end_inclusive
+                else Transaction.transaction_date < edge_end
+            ),
+        )
+        .group_by(Transaction.user_id)
+        for edge_start, edge_end, end_inclusive in edges
+    ]
+    if full_days:
+        first_full_day, last_full_day = full_days
+        query = select(
+            UserDailyTransactionSummary.user_id.label("user_id"),
+            UserDailyTransactionSummary.credit_total.label("credit_total"),
+            UserDailyTransactionSummary.debit_total.label("debit_total"),
+        ).where(
+            UserDailyTransactionSummary.user_id.in_(user_ids),
+            UserDailyTransactionSummary.day <= last_full_day,
+        )
+        if first_full_day:
+            query = query.where(UserDailyTransactionSummary.day >= first_full_day)
+        parts.append(query)
+
+    if not parts:
+        parts.append(
+            select(
+                Transaction.user_id.label("user_id"),
+                literal_column("0").label("credit_total"),
+                literal_column("0").label("debit_total"),
+            ).where(false())
+        )
+
+    totals = union_all(*parts).subquery()
+    return select(
+        totals.c.user_id,
+        func.sum(totals.c.credit_total).label("credit_total"),
+        func.sum(totals.c.debit_total).label("debit_total"),
+    ).group_by(totals.c.user_id)
+
+
+def bucket_start(value: datetime, bucket: SeriesBucket) -> datetime:
+    """Start of the bucket a date falls in, in UTC without a timezone. Weeks
+    start on Monday."""
+
+    start = transaction_hour(value)
+    if bucket == SeriesBucket.HOUR:
+        return start
+
+    start = start.replace(hour=0)
+    if bucket == SeriesBucket.WEEK:
+        return start - timedelta(days=start.weekday())
+    if bucket == SeriesBucket.MONTH:
+        return start.replace(day=1)
+    return start
+
+
+def next_bucket_start(value: datetime, bucket: SeriesBucket) -> datetime:
+    start = bucket_start(value, bucket)
+    if bucket == SeriesBucket.HOUR:
+        return start + timedelta(hours=1)
+    if bucket == SeriesBucket.DAY:
+        return start + timedelta(days=1)
+    if bucket == SeriesBucket.WEEK:
+        return start + timedelta(weeks=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def series_query(
+    user_id: int,
+    bucket: SeriesBucket,
+    start: datetime | None,
+    end: datetime | None,
+):
+    """A user's rollup rows between the start of the bucket start falls in and
+    the end of the bucket end falls in. Hours come from the hourly rollup,
+    everything coarser from the daily one."""
+
+    hourly = bucket == SeriesBucket.HOUR
+    model = UserHourlyTransactionSummary if hourly else UserDailyTransactionSummary
+    period = model.hour if hourly else model.day
+
+    query = (
+        select(
+            period,
+            model.credit_count,
+            model.debit_count,
+            model.credit_total,
+            model.debit_total,
+        )
+        .where(model.user_id == user_id)
+        .order_by(period)
+    )
+    if start:
+        start = bucket_start(start, bucket)
+        query = query.where(period >= (start if hourly else start.date()))
+    if end:
+        end = next_bucket_start(end, bucket)
+        query = query.where(period < (end if hourly else end.date()))
+    return query
+
+
+async def transaction_series(
+    session: AsyncSession,
+    user_id: int,
+    bucket: SeriesBucket,
+    start: datetime | None,
+    end: datetime | None,
+) -> list[dict]:
+    """Counts, totals and averages per transaction type for every bucket with
+    transactions, oldest first. Weeks and months are summed from at most a
+    few hundred daily rows per year."""
+
+    buckets = {}
+    results = await session.exec(series_query(user_id, bucket, start, end))
+    for period, *values in results:
+        if not isinstance(period, datetime):
+            period = datetime.combine(period, time.min)
+        totals = buckets.setdefault(bucket_start(period, bucket), [0, 0, 0.0, 0.0])
+        for index, value in enumerate(values):
+            totals[index] += value
+
+    series = []
+    for period, (
+        credit_count,
+        debit_count,
+        credit_total,
+        debit_total,
+    ) in buckets.items():
+        # Rows of deleted transactions stay behind with nothing in them
+        if not credit_count and not debit_count:
+            continue
+
+        series.append(
+            {
+                "start": period.replace(tzinfo=timezone.utc),
+                "transaction_count": credit_count + debit_count,
+                "transaction_total": round(credit_total + debit_total, 2),
+                "credit_count": credit_count,
+                "credit_total": round(credit_total, 2),
+                "average_credit_value": (
+                    round(credit_total / credit_count, 2) if credit_count else 0
+                ),
+                "debit_count": debit_count,
+                "debit_total": round(debit_total, 2),
+                "average_debit_value": (
+                    round(debit_total / debit_count, 2) if debit_count else 0
+                ),
+            }
+        )
+    return series
+
+
+def amount_sketch_query(
+    user_id: int | None, start: datetime | None, end: datetime | None
+):
+    """The daily amount sketches of a user, or of every user (all shards),
+    from the day start falls on to the day end falls on merged into one, as
+    (bucket, count) rows."""
+
+    model = UserDailyAmountSketch if user_id else DailyAmountSketch
+    query = select(model.bucket, func.sum(model.transaction_count)).group_by(
+        model.bucket
+    )
+    if user_id:
+        query = query.where(UserDailyAmountSketch.user_id == user_id)
+    if start:
+        query = query.where(model.day >= transaction_day(start))
+    if end:
+        query = query.where(model.day <= transaction_day(end))
+    return query
+
+
+async def amount_percentiles(
+    session: AsyncSession,
+    user_id: int | None,
+    start: datetime | None,
+    end: datetime | None,
+) -> dict:
+    """Median, p90 and p99 of the transaction amounts of a user (or every
+    user) within 1% (see transaction.sketch), over whole days. They are None
+    when there are no transactions."""
+
+    results = await session.exec(amount_sketch_query(user_id, start, end))
+    sketch = AmountSketch(dict(results.all()))
+
+    percentiles = {"transaction_count": sketch.count}
+    for name, q in AMOUNT_PERCENTILES.items():
+        amount = sketch.quantile(q)
+        percentiles[name] = None if amount is None else round(amount, 2)
+    return percentiles
+
+
+async def rebuild_aggregates(session: AsyncSession):
+    """Recompute every aggregate from the transaction table. Only meant for
+    backfilling, the write paths keep the aggregates up to date after that."""
+
+    await session.exec(delete(UserTransactionSummary))
+    await session.exec(delete(UserDailyTransactionSummary))
+    await session.exec(delete(UserHourlyTransactionSummary))
+    await session.exec(delete(UserDailyAmountSketch))
+    await session.exec(delete(DailyAmountSketch))
+
+    summary_query = select(
+        Transaction.user_id,
+        func.count(Transaction.id),
+        func.sum(Transaction.transaction_amount),
+        func.sum(amount_of_type(TransactionType.CREDIT)),
+        func.sum(amount_of_type(TransactionType.DEBIT)),
+    ).group_by(Transaction.user_id)
+
+    await session.exec(
+        UserTransactionSummary.__table__.insert().from_select(
+            [
+                "user_id",
+                "transaction_count",
+                "transaction_total",
+                "credit_total",
+                "debit_total",
+            ],
+            summary_query,
+        )
+    )
+
+    day = transaction_day_column(session)
+    days = (
+        select(
+            Transaction.user_id.label("user_id"),
+            day.label("day"),
+            func.count(Transaction.id).label("transaction_count"),
+            count_of_type(TransactionType.CREDIT).label("credit_count"),
+            count_of_type(TransactionType.DEBIT).label("debit_count"),
+            func.sum(amount_of_type(TransactionType.CREDIT)).label("credit_total"),
+            func.sum(amount_of_type(TransactionType.DEBIT)).label("debit_total"),
+        )
+        .where(Transaction.transaction_date.is_not(None))
+        .group_by(Transaction.user_id, day)
+        .subquery()
+    )
+    daily_query = select(
+        days.c.user_id,
+        days.c.day,
+        days.c.transaction_count,
+        days.c.credit_count,
+        days.c.debit_count,
+        days.c.credit_total,
+        days.c.debit_total,
+        func.sum(days.c.credit_total).over(
+            partition_by=days.c.user_id, order_by=days.c.day
+        ),
+        func.sum(days.c.debit_total).over(
+            partition_by=days.c.user_id, order_by=days.c.day
+        ),
+    )
+
+    await session.exec(
+        UserDailyTransactionSummary.__table__.insert().from_select(
+            [
+                "user_id",
+                "day",
+                "transaction_count",
+                "credit_count",
+                "debit_count",
+                "credit_total",
+                "debit_total",
+                "cumulative_credit_total",
+                "cumulative_debit_total",
+            ],
+            daily_query,
+        )
+    )
+
+    hour = transaction_hour_column(session)
+    hourly_query = (
+        select(
+            Transaction.user_id,
+            hour,
+            count_of_type(TransactionType.CREDIT),
+            count_of_type(TransactionType.DEBIT),
+            func.sum(amount_of_type(TransactionType.CREDIT)),
+            func.sum(amount_of_type(TransactionType.DEBIT)),
+        )
+        .where(Transaction.transaction_date.is_not(None))
+        .group_by(Transaction.user_id, hour)
+    )
+
+    await session.exec(
+        UserHourlyTransactionSummary.__table__.insert().from_select(
+            [
+                "user_id",
+                "hour",
+                "credit_count",
+                "debit_count",
+                "credit_total",
+                "debit_total",
+            ],
+            hourly_query,
+        )
+    )
+
+    # Bucketed here rather than in SQL, so the buckets are exactly the ones
+    # the write path computes
+    sketches = defaultdict(int)
+    results = await session.stream(
+        select(
+            Transaction.user_id,
+            Transaction.transaction_date,
+            Transaction.transaction_amount,
+        )
+        .where(Transaction.transaction_date.is_not(None))
+        .execution_options(yield_per=10_000)
+    )
+    async for user_id, transaction_date, transaction_amount in results:
+        sketches[
+            (
+                user_id,
+                transaction_day(transaction_date),
+                amount_bucket(transaction_amount),
+            )
+        ] += 1
+
+    everyone = defaultdict(int)
+    for (user_id, day, bucket), count in sketches.items():
+        everyone[(day, bucket, amount_sketch_shard(user_id))] += count
+
+    if sketches:
+        await session.exec(
+            insert(UserDailyAmountSketch),
+            params=[
+                {
+                    "user_id": user_id,
+                    "day": day,
+                    "bucket": bucket,
+                    "transaction_count": count,
+                }
+                for (user_id, day, bucket), count in sketches.items()
+            ],
+        )
+        await session.exec(
+            insert(DailyAmountSketch),
+            params=[
+                {
+                    "day": day,
+                    "bucket": bucket,
+                    "shard": shard,
+                    "transaction_count": count,
+                }
+                for (day, bucket, shard), count in everyone.items()
+            ],
+        )
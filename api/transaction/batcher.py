@@ -0,0 +1,107 @@
+import asyncio
+
+from redis.asyncio import Redis
+from sqlalchemy import insert
+
+import metrics
+from db import async_session
+from settings import settings
+from transaction.aggregates import AggregateDeltas
+from transaction.cache import invalidate_user_cache
+from transaction.models import Transaction, TransactionCreate
+
+
+class TransactionBatcher:
+    """Group commit for POST /core/. Transactions created concurrently are
+    collected for up to max_delay seconds (or until max_size of them are
+    waiting), written with one multi-row INSERT ... RETURNING in one database
+    transaction, and every caller gets its own row back. Aggregates and caches
+    are updated once per user of the batch.
+
+    The rows are validated before they are queued, so a batch only fails on a
+    database error, which is raised to every caller in it."""
+
+    def __init__(self, max_size: int, max_delay: float):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending: list[tuple[TransactionCreate, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.rc: Redis | None = None
+        self.writes: set[asyncio.Task] = set()
+
+    async def create(self, rc: Redis, payload: TransactionCreate) -> Transaction:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((payload, future))
+        self.rc = rc
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif not self.timer:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self.flush
+            )
+
+        # Shielded so a caller that goes away doesn't cancel the write of the
+        # rest of the batch
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.write(self.rc, batch))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    async def write(
+        self, rc: Redis, batch: list[tuple[TransactionCreate, asyncio.Future]]
+    ):
+        # The batch runs in a copy of whichever request's context queued the
+        # write, its queries aren't that request's
+        metrics.current.set(None)
+
+        deltas = AggregateDeltas()
+        for payload, _ in batch:
+            deltas.add(payload)
+
+        try:
+            async with async_session() as session:
+                results = await session.exec(
+                    insert(Transaction).returning(
+                        Transaction, sort_by_parameter_order=True
+                    ),
+                    params=[payload.model_dump() for payload, _ in batch],
+                )
+                transactions = results.scalars().all()
+                await deltas.apply(session)
+                await session.commit()
+
+            # A lookup of an id before it existed may have cached a null
+            await invalidate_user_cache(
+                rc,
+                *deltas.user_ids,
+                transaction_ids=[transaction.id for transaction in transactions],
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), transaction in zip(batch, transactions):
+            if not future.done():
+                future.set_result(transaction)
+
+    async def drain(self):
+        """Write whatever is still queued, for shutting down."""
+        self.flush()
+        if self.writes:
+            await asyncio.gather(*self.writes, return_exceptions=True)
+
+
+batcher = TransactionBatcher(
+    settings.WRITE_BATCH_MAX_SIZE, settings.WRITE_BATCH_MAX_DELAY_SECONDS
+)
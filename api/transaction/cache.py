@@ -0,0 +1,468 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from time import monotonic, time, time_ns
+from typing import Awaitable, Callable, Iterable
+from uuid import uuid4
+
+from fastapi import Request, Response
+from orjson import dumps
+from pydantic import BaseModel
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+from metrics import record_cache, timer
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+TRANSACTIONS_ANALYTICS_TTL_SECONDS = 300
+TRANSACTIONS_HISTORY_TTL_SECONDS = 120
+
+# Ids that don't exist are cached as null too, for less time as bulk inserts
+# don't invalidate the ids they create
+TRANSACTIONS_NOT_FOUND_TTL_SECONDS = 30
+NOT_FOUND = b"null"
+
+# How long another worker's computation of the same keys is waited for before
+# computing them anyway, and how often the cache is checked while waiting
+FILL_LOCK_TTL_MILLISECONDS = 5000
+FILL_WAIT_SECONDS = 2
+FILL_POLL_SECONDS = 0.02
+
+# A transaction is cached under its version, like everything else under a
+# generation, so a body read before a write is never read under the version
+# the write bumped to
+REDIS_KEY_TRANSACTION = "transaction:{0}:{1}"
+
+# Bumped whenever the transaction changes, its ETag. It expires as it's only
+# worth keeping while clients are polling the transaction.
+REDIS_KEY_TRANSACTION_VERSION = "transaction_version:{0}"
+TRANSACTION_VERSION_TTL_SECONDS = 24 * 60 * 60
+
+# Every cached key for a user embeds that user's generation counter. Writes bump
+# the counter instead of hunting down and deleting keys, so old entries are
+# simply never read again and fall out of Redis when their TTL runs out.
+REDIS_KEY_GENERATION = "generation:{0}"
+
+REDIS_KEY_TRANSACTIONS_PAGE = "transactions:{0}:{1}:{2}"
+REDIS_KEY_AVERAGE_TRANSACTION_VALUE = "analytics:{0}:{1}:average_transaction_value"
+REDIS_KEY_DAY_OF_HIGHEST_NUMBER_OF_TRANSACTIONS = (
+    "analytics:{0}:{1}:day_of_highest_number_of_transactions"
+)
+REDIS_KEY_HIGHEST_NUMBER_OF_TRANSACTIONS_IN_A_DAY = (
+    "analytics:{0}:{1}:highest_number_of_transaction_in_a_day"
+)
+REDIS_KEY_TOTAL_DEBIT_VALUE = "analytics:{0}:{1}:total_debit_value:{2}:{3}"
+REDIS_KEY_TOTAL_CREDIT_VALUE = "analytics:{0}:{1}:total_credit_value:{2}:{3}"
+REDIS_KEY_ANALYTICS_SERIES = "analytics:{0}:{1}:series:{2}:{3}:{4}"
+REDIS_KEY_ANALYTICS_PERCENTILES = "analytics:{0}:{1}:percentiles:{2}:{3}"
+
+REDIS_KEY_FILL_LOCK = "lock:{0}"
+
+# Set for DATABASE_READ_YOUR_WRITES_SECONDS when a version (generation) is
+# bumped, values cached under it meanwhile are read from the primary. A replica
+# may not have the write yet, and what it returns would be cached as the value
+# of the new version until the key expires.
+REDIS_KEY_RECENT_WRITE = "recent_write:{0}"
+
+# The date ranges analytics have been computed for on a request per user,
+# scored by when, so they can be recomputed after a write. Not part of the
+# generation, the ranges outlive it. Ranges asked for longer ago than the
+# analytics TTL, and all but the most recent ones, are dropped.
+REDIS_KEY_ANALYTICS_RANGES = "recent_analytics_ranges:{0}"
+ANALYTICS_RANGES_MAX_COUNT = 20
+
+# Users whose analytics need recomputing, consumed by transaction.worker
+REDIS_STREAM_ANALYTICS_RECOMPUTE = "stream:analytics_recompute"
+ANALYTICS_RECOMPUTE_STREAM_MAXLEN = 100_000
+
+# Keys whose value changes in place (generations, transaction versions) are
+# published here when they do, so every process drops its local copy. "*"
+# drops everything, it has to be published after Redis is flushed by hand.
+REDIS_CHANNEL_INVALIDATIONS = "invalidations"
+INVALIDATE_ALL = "*"
+
+
+class LocalCache:
+    """Bounded LRU of Redis values in process memory, in front of Redis.
+
+    Everything cached under a generation is immutable, so only the keys
+    published on REDIS_CHANNEL_INVALIDATIONS can go stale. Values are only
+    served while the invalidation subscription is up, and everything is
+    dropped whenever it (re)connects. The TTL caps the staleness if a message
+    is ever lost."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.subscribed = False
+        # Bumped on every invalidation, a value read from Redis before one is
+        # not stored as it may be the old value
+        self.version = 0
+
+    def get(self, key: str) -> bytes | None:
+        if not self.subscribed or not (entry := self.entries.get(key)):
+            return None
+
+        expires, value = entry
+        if expires < monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes, version: int):
+        if not self.subscribed or version != self.version:
+            return
+
+        self.entries[key] = (monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *keys: str):
+        self.version += 1
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self.entries.clear()
+
+
+local_cache = LocalCache(
+    settings.LOCAL_CACHE_MAX_ENTRIES, settings.LOCAL_CACHE_TTL_SECONDS
+)
+
+
+async def listen_for_invalidations(rc: Redis):
+    """Keep the local cache coherent with Redis, runs until cancelled."""
+
+    while True:
+        try:
+            async with rc.pubsub() as pubsub:
+                await pubsub.subscribe(REDIS_CHANNEL_INVALIDATIONS)
+                async for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        local_cache.clear()
+                        local_cache.subscribed = True
+                    elif message["type"] == "message":
+                        keys = message["data"].decode().split()
+                        if INVALIDATE_ALL in keys:
+                            local_cache.clear()
+                        else:
+                            local_cache.invalidate(*keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Lost the cache invalidation subscription")
+        finally:
+            # Invalidations may be missed until the subscription is back
+            local_cache.subscribed = False
+            local_cache.clear()
+
+        await asyncio.sleep(1)
+
+
+async def cache_get(rc: Redis, key: str) -> bytes | None:
+    value = local_cache.get(key)
+    if value is not None:
+        record_cache(key, "local")
+        return value
+
+    version = local_cache.version
+    with timer("redis"):
+        value = await rc.get(key)
+    if value is not None:
+        local_cache.set(key, value, version)
+    record_cache(key, "miss" if value is None else "hit")
+    return value
+
+
+async def cache_mget(rc: Redis, keys: list[str]) -> list[bytes | None]:
+    values = [local_cache.get(key) for key in keys]
+    if None not in values:
+        for key in keys:
+            record_cache(key, "local")
+        return values
+
+    version = local_cache.version
+    with timer("redis"):
+        values = await rc.mget(keys)
+    for key, value in zip(keys, values):
+        if value is not None:
+            local_cache.set(key, value, version)
+        record_cache(key, "miss" if value is None else "hit")
+    return values
+
+
+async def get_versions(rc: Redis, keys: list[str], ttl: int | None = None) -> list[int]:
+    """The values of version counters (generations), created if missing.
+
+    Counters start from the current time rather than 0, so one that is lost
+    (Redis flushed, the key expired) never comes back with a value it had
+    before. ETags are built from them and must not match a different body."""
+
+    values = await cache_mget(rc, keys)
+    if missing := [key for key, value in zip(keys, values) if value is None]:
+        version = local_cache.version
+        pipe = rc.pipeline(transaction=False)
+        for key in missing:
+            pipe.set(key, time_ns(), nx=True, ex=ttl)
+            pipe.get(key)
+        with timer("redis"):
+            created = dict(zip(missing, (await pipe.execute())[1::2]))
+        for key, value in created.items():
+            local_cache.set(key, value, version)
+        values = [created.get(key, value) for key, value in zip(keys, values)]
+    return [int(value) for value in values]
+
+
+async def get_version(rc: Redis, key: str, ttl: int | None = None) -> int:
+    [version] = await get_versions(rc, [key], ttl)
+    return version
+
+
+async def get_generation(rc: Redis, user_id: int | str) -> int:
+    return await get_version(rc, REDIS_KEY_GENERATION.format(user_id))
+
+
+async def invalidate_user_cache(
+    rc: Redis, *user_ids: int, transaction_ids: Iterable[int] = ()
+):
+    # The "all" generation covers the listing across every user, which changes
+    # whenever any single user's transactions do
+    keys = [REDIS_KEY_GENERATION.format(user_id) for user_id in {*user_ids, "all"}]
+    version_keys = [REDIS_KEY_TRANSACTION_VERSION.format(id) for id in transaction_ids]
+
+    pipe = rc.pipeline(transaction=False)
+    if settings.DATABASE_REPLICA_URLS:
+        # Before the bumps, whoever reads a new version also sees its marker
+        for key in keys + version_keys:
+            pipe.set(
+                REDIS_KEY_RECENT_WRITE.format(key),
+                1,
+                ex=settings.DATABASE_READ_YOUR_WRITES_SECONDS,
+            )
+    for key in keys:
+        pipe.set(key, time_ns(), nx=True)
+        pipe.incr(key)
+    for key in version_keys:
+        pipe.set(key, time_ns(), nx=True, ex=TRANSACTION_VERSION_TTL_SECONDS)
+        pipe.incr(key)
+    pipe.publish(REDIS_CHANNEL_INVALIDATIONS, " ".join(keys + version_keys))
+    # Queued in the same round trip, the recomputation itself happens in the
+    # worker and never on the request
+    for user_id in set(user_ids):
+        pipe.xadd(
+            REDIS_STREAM_ANALYTICS_RECOMPUTE,
+            {"user_id": user_id},
+            maxlen=ANALYTICS_RECOMPUTE_STREAM_MAXLEN,
+            approximate=True,
+        )
+    with timer("redis"):
+        await pipe.execute()
+
+    # This process doesn't wait for its own message to read its writes
+    local_cache.invalidate(*keys, *version_keys)
+
+
+async def written_recently(rc: Redis, *version_keys: str) -> bool:
+    """Whether any of the versions was bumped in the last
+    DATABASE_READ_YOUR_WRITES_SECONDS, always False without read replicas."""
+
+    if not settings.DATABASE_REPLICA_URLS or not version_keys:
+        return False
+
+    with timer("redis"):
+        return bool(
+            await rc.exists(
+                *[REDIS_KEY_RECENT_WRITE.format(key) for key in version_keys]
+            )
+        )
+
+
+def remember_analytics_range(pipe: Pipeline, user_id: int, analytics_range: str):
+    # Queued with the analytics values being stored, in the same round trip
+    key = REDIS_KEY_ANALYTICS_RANGES.format(user_id)
+    now = time()
+    pipe.zadd(key, {analytics_range: now})
+    pipe.zremrangebyscore(key, "-inf", now - TRANSACTIONS_ANALYTICS_TTL_SECONDS)
+    pipe.zremrangebyrank(key, 0, -ANALYTICS_RANGES_MAX_COUNT - 1)
+    pipe.expire(key, TRANSACTIONS_ANALYTICS_TTL_SECONDS)
+
+
+async def recent_analytics_ranges(rc: Redis, user_id: int) -> list[bytes]:
+    return await rc.zrangebyscore(
+        REDIS_KEY_ANALYTICS_RANGES.format(user_id),
+        time() - TRANSACTIONS_ANALYTICS_TTL_SECONDS,
+        "+inf",
+    )
+
+
+def default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    raise TypeError
+
+
+def encode(value) -> bytes:
+    """Serialise a response body once, to the exact bytes that are cached in
+    Redis and sent to the client."""
+    with timer("serialize"):
+        return dumps(value, default=default)
+
+
+def json_response(payload: bytes, etag: str | None = None) -> Response:
+    # Cached payloads are already JSON, they go out as they are instead of
+    # being parsed and encoded again
+    return Response(
+        payload,
+        media_type="application/json",
+        headers={"ETag": etag} if etag else None,
+    )
+
+
+def etag(*versions: int | str) -> str:
+    """A strong ETag from the versions (generations) a response is built
+    from, it changes whenever they do."""
+    return '"{}"'.format("-".join(str(version) for version in versions))
+
+
+def not_modified(request: Request, etag: str, exists: bool = True) -> Response | None:
+    """A 304 if the client already has the response with this ETag. Answered
+    from the version alone, the body is never read. "*" matches whatever the
+    resource is, as long as it exists."""
+
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if etag in tags or (exists and "*" in tags):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def as_cached(value) -> bytes:
+    # The same bytes redis-py would have stored, so a computed value and one
+    # read back from Redis look the same to the caller
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+async def store(
+    rc: Redis,
+    values: dict[str, bytes],
+    ttl: int,
+    not_found_ttl: int | None = None,
+    also: Callable[[Pipeline], None] | None = None,
+):
+    """Cache the values, in one pipeline with whatever `also` queues on it."""
+
+    pipe = rc.pipeline(transaction=False)
+    for key, value in values.items():
+        pipe.set(
+            key, value, not_found_ttl if value == NOT_FOUND and not_found_ttl else ttl
+        )
+    if also:
+        also(pipe)
+    with timer("redis"):
+        await pipe.execute()
+
+
+async def compute_and_store(
+    rc: Redis,
+    keys: list[str],
+    ttl: int,
+    compute: Callable[[], Awaitable[list]],
+    also: Callable[[Pipeline], None] | None = None,
+    not_found_ttl: int | None = None,
+) -> list[bytes]:
+    values = [as_cached(value) for value in await compute()]
+    await store(rc, dict(zip(keys, values)), ttl, not_found_ttl, also)
+    return values
+
+
+async def fill_across_workers(
+    rc: Redis,
+    keys: list[str],
+    ttl: int,
+    compute: Callable[[], Awaitable[list]],
+    also: Callable[[Pipeline], None] | None = None,
+    not_found_ttl: int | None = None,
+) -> list[bytes]:
+    lock_key = REDIS_KEY_FILL_LOCK.format(",".join(keys))
+
+    with timer("redis"):
+        locked = await rc.set(
+            lock_key, uuid4().hex, nx=True, px=FILL_LOCK_TTL_MILLISECONDS
+        )
+
+    if locked:
+        # Released in the pipeline that stores the values, so other workers
+        # wait on the lock until the values are there. Worst case the lock
+        # already expired and this releases another worker's lock, which only
+        # costs one duplicate computation.
+        def store_and_release(pipe: Pipeline):
+            if also:
+                also(pipe)
+            pipe.delete(lock_key)
+
+        try:
+            return await compute_and_store(
+                rc, keys, ttl, compute, store_and_release, not_found_ttl
+            )
+        except BaseException:
+            with timer("redis"):
+                await rc.delete(lock_key)
+            raise
+
+    # Another worker holds the lock, wait for it to fill the keys
+    deadline = monotonic() + FILL_WAIT_SECONDS
+    while monotonic() < deadline:
+        await asyncio.sleep(FILL_POLL_SECONDS)
+        with timer("redis"):
+            values = await rc.mget(keys)
+        if all(value is not None for value in values):
+            return values
+
+    return await compute_and_store(rc, keys, ttl, compute, also, not_found_ttl)
+
+
+_in_flight: dict[str, asyncio.Task] = {}
+
+
+async def fill(
+    rc: Redis,
+    keys: list[str],
+    ttl: int,
+    compute: Callable[[], Awaitable[list]],
+    also: Callable[[Pipeline], None] | None = None,
+    not_found_ttl: int | None = None,
+) -> list[bytes]:
+    """Compute the values of cache keys that missed and store them, making
+    sure only one computation for the same keys runs at a time. Concurrent
+    callers in this process await the same task and callers in other workers
+    wait on a short Redis lock, instead of all running the same query when a
+    hot key expires or is invalidated. `also` queues more commands in the
+    pipeline that stores the values, only the caller that computes runs it.
+    Values that are null are stored for not_found_ttl when it is given."""
+
+    # Keyed on every key, requests that share some keys but not others (e.g.
+    # analytics for different date ranges) compute separately
+    flight = ",".join(keys)
+    task = _in_flight.get(flight)
+
+    if not task:
+        task = asyncio.ensure_future(
+            fill_across_workers(rc, keys, ttl, compute, also, not_found_ttl)
+        )
+        _in_flight[flight] = task
+        task.add_done_callback(lambda _: _in_flight.pop(flight, None))
+
+    # Shielded so a caller that goes away (e.g. the client disconnects) doesn't
+    # cancel the computation the other callers are waiting on
+    return await asyncio.shield(task)
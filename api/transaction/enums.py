@@ -1,5 +1,18 @@
 from enum import Enum
 
+
 class TransactionType(str, Enum):
     CREDIT = "credit"
-    DEBIT = "debit"
\ No newline at end of file
+    DEBIT = "debit"
+
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+class SeriesBucket(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
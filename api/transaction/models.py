@@ -1,23 +1,129 @@
+from pydantic import conlist
 from sqlmodel import SQLModel, Field
-from datetime import datetime
+from datetime import datetime, date
 from transaction.enums import TransactionType
-from sqlalchemy import Column, DateTime
+from sqlalchemy import Column, DateTime, Enum, Index
 
 
 class TransactionBase(SQLModel):
     user_id: int
     full_name: str
-    transaction_date: datetime = Field(sa_column=Column(DateTime(timezone=True)))
+    transaction_date: datetime = Field(
+        sa_column=Column(DateTime(timezone=True), nullable=False)
+    )
     transaction_amount: float
-    transaction_type: TransactionType
+    # The column is a plain varchar holding the member names (see
+    # db/01-init.sql), not a Postgres enum type
+    transaction_type: TransactionType = Field(
+        sa_column=Column(Enum(TransactionType, native_enum=False), nullable=False)
+    )
 
 
 class Transaction(TransactionBase, table=True):
+    __table_args__ = (
+        # Listing a user's history newest first (keyset on date and id), and
+        # summing the partial days at the edges of an analytics date range
+        Index(
+            "ix_transaction_user_id_transaction_date",
+            "user_id",
+            "transaction_date",
+            "id",
+            postgresql_include=["transaction_amount", "transaction_type"],
+        ),
+        Index(
+            "ix_transaction_user_id_transaction_type",
+            "user_id",
+            "transaction_type",
+            postgresql_include=["transaction_amount"],
+        ),
+        # Listing every user's history newest first
+        Index("ix_transaction_transaction_date", "transaction_date", "id"),
+    )
+
+    # The table is partitioned by month on transaction_date (see
+    # transaction.partitions), so in Postgres the primary key is
+    # (id, transaction_date). Ids are still unique, they come from one sequence.
     id: int = Field(default=None, nullable=False, primary_key=True)
 
 
 class TransactionCreate(TransactionBase):
     pass
 
+
 class TransactionUpdate(TransactionBase):
-    pass
\ No newline at end of file
+    pass
+
+
+class AnalyticsBatch(SQLModel):
+    user_ids: conlist(int, min_length=1, max_length=10_000)
+    transaction_value_start_date: datetime | None = None
+    transaction_value_end_date: datetime | None = None
+
+
+class UserTransactionSummary(SQLModel, table=True):
+    __tablename__ = "user_transaction_summary"
+
+    user_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    transaction_count: int = 0
+    transaction_total: float = 0
+    credit_total: float = 0
+    debit_total: float = 0
+
+
+class UserDailyTransactionSummary(SQLModel, table=True):
+    __tablename__ = "user_daily_transaction_summary"
+    __table_args__ = (
+        Index(
+            "ix_user_daily_transaction_summary_user_id_transaction_count",
+            "user_id",
+            "transaction_count",
+            "day",
+        ),
+    )
+
+    user_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    day: date = Field(primary_key=True)
+    transaction_count: int = 0
+    credit_count: int = 0
+    debit_count: int = 0
+    credit_total: float = 0
+    debit_total: float = 0
+    # Running totals over every day up to and including this one, so the totals
+    # between two days are the difference of two rows
+    cumulative_credit_total: float = 0
+    cumulative_debit_total: float = 0
+
+
+class UserHourlyTransactionSummary(SQLModel, table=True):
+    __tablename__ = "user_hourly_transaction_summary"
+
+    user_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    # Start of the hour in UTC, without a timezone
+    hour: datetime = Field(primary_key=True)
+    credit_count: int = 0
+    debit_count: int = 0
+    credit_total: float = 0
+    debit_total: float = 0
+
+
+class UserDailyAmountSketch(SQLModel, table=True):
+    __tablename__ = "user_daily_amount_sketch"
+
+    user_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    day: date = Field(primary_key=True)
+    # How many of the day's transactions have an amount in the bucket, together
+    # the rows of a day are a DDSketch of its amounts (see transaction.sketch)
+    bucket: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    transaction_count: int = 0
+
+
+class DailyAmountSketch(SQLModel, table=True):
+    __tablename__ = "daily_amount_sketch"
+
+    # UserDailyAmountSketch summed over every user, split in AMOUNT_SKETCH_SHARDS
+    # rows by user_id so writes of different users don't all update the same
+    # row. A day's sketch is the sum over the shards.
+    day: date = Field(primary_key=True)
+    bucket: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    shard: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    transaction_count: int = 0
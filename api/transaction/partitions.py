@@ -0,0 +1,189 @@
+"""Monthly partitions of the transaction table.
+
+The table is partitioned by range on transaction_date (see migration 0005),
+one partition per UTC month named transaction_yYYYYmMM, plus
+transaction_default for dates no partition covers. Partitions are created a
+few months ahead so the default partition stays empty. Old months can be
+detached, which leaves them as plain tables to be archived (pg_dump -t) and
+dropped. Their transactions stay counted in the aggregates.
+
+    python -m transaction.partitions ensure
+    python -m transaction.partitions detach --before 2024-01-01 [--drop]
+"""
+
+import argparse
+import asyncio
+import logging
+import re
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from db import engine
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_PARTITION = "transaction_y{0:%Y}m{0:%m}"
+TRANSACTION_PARTITION_PATTERN = re.compile(r"transaction_y(\d{4})m(\d{2})")
+TRANSACTION_DEFAULT_PARTITION = "transaction_default"
+
+TRANSACTION_PARTITION_MAINTENANCE_INTERVAL_SECONDS = 6 * 60 * 60
+
+# Any constant, keeps API processes maintaining the partitions at the same
+# time from creating the same one twice
+TRANSACTION_PARTITION_LOCK = 5_032_021
+
+
+def next_month(month: date) -> date:
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def partition_bounds(month: date) -> str:
+    return f"FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{next_month(month):%Y-%m-%d} 00:00+00')"
+
+
+async def partition_months(conn: AsyncConnection) -> dict[date, str]:
+    results = await conn.execute(text("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = '"transaction"'::regclass
+            """))
+
+    months = {}
+    for name in results.scalars():
+        if match := TRANSACTION_PARTITION_PATTERN.fullmatch(name):
+            months[date(int(match[1]), int(match[2]), 1)] = name
+    return months
+
+
+async def create_partition(conn: AsyncConnection, month: date) -> str:
+    """Transactions of the month that landed in the default partition are
+    moved into the new one, attaching it would fail otherwise."""
+
+    name = TRANSACTION_PARTITION.format(month)
+    start = datetime.combine(month, datetime.min.time(), tzinfo=timezone.utc)
+    end = datetime.combine(next_month(month), datetime.min.time(), tzinfo=timezone.utc)
+
+    await conn.execute(
+        text(f'CREATE TABLE {name} (LIKE "transaction" INCLUDING DEFAULTS)')
+    )
+    await conn.execute(
+        text(f"""
+            WITH moved AS (
+                DELETE FROM {TRANSACTION_DEFAULT_PARTITION}
+                WHERE transaction_date >= :start AND transaction_date < :end
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """),
+        {"start": start, "end": end},
+    )
+    # The indexes of the table are created on the partition as it's attached
+    await conn.execute(
+        text(
+            f'ALTER TABLE "transaction" ATTACH PARTITION {name} '
+            f"FOR VALUES {partition_bounds(month)}"
+        )
+    )
+    return name
+
+
+async def ensure_partitions(
+    conn: AsyncConnection,
+    months_ahead: int = settings.TRANSACTION_PARTITIONS_AHEAD_MONTHS,
+) -> list[str]:
+    """Create the partitions of the current month and the months_ahead after
+    it that don't exist yet."""
+
+    await conn.execute(
+        text("SELECT pg_advisory_xact_lock(:lock)"),
+        {"lock": TRANSACTION_PARTITION_LOCK},
+    )
+    existing = await partition_months(conn)
+
+    created = []
+    month = datetime.now(timezone.utc).date().replace(day=1)
+    for _ in range(months_ahead + 1):
+        if month not in existing:
+            created.append(await create_partition(conn, month))
+        month = next_month(month)
+    return created
+
+
+async def detach_partitions(
+    conn: AsyncConnection, before: date, drop: bool = False
+) -> list[str]:
+    """Detach the partitions of the months that end on or before the given
+    date, dropping them too if asked to."""
+
+    await conn.execute(
+        text("SELECT pg_advisory_xact_lock(:lock)"),
+        {"lock": TRANSACTION_PARTITION_LOCK},
+    )
+
+    detached = []
+    for month, name in sorted((await partition_months(conn)).items()):
+        if next_month(month) > before:
+            continue
+
+        await conn.execute(text(f'ALTER TABLE "transaction" DETACH PARTITION {name}'))
+        if drop:
+            await conn.execute(text(f"DROP TABLE {name}"))
+        detached.append(name)
+    return detached
+
+
+async def run():
+    """Keep partitions ahead of the current month, runs until cancelled."""
+
+    while True:
+        try:
+            async with engine.begin() as conn:
+                created = await ensure_partitions(conn)
+            if created:
+                logger.info("Created transaction partitions %s", ", ".join(created))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Creating transaction partitions failed")
+
+        await asyncio.sleep(TRANSACTION_PARTITION_MAINTENANCE_INTERVAL_SECONDS)
+
+
+async def main(args):
+    async with engine.begin() as conn:
+        if args.command == "ensure":
+            names = await ensure_partitions(conn, args.months_ahead)
+        else:
+            names = await detach_partitions(conn, args.before, args.drop)
+    await engine.dispose()
+
+    print("\n".join(names) or "Nothing to do")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ensure = commands.add_parser("ensure", help="Create upcoming partitions")
+    ensure.add_argument(
+        "--months-ahead", type=int, default=settings.TRANSACTION_PARTITIONS_AHEAD_MONTHS
+    )
+
+    detach = commands.add_parser("detach", help="Detach (archive) old partitions")
+    detach.add_argument(
+        "--before",
+        type=date.fromisoformat,
+        required=True,
+        help="Months ending on or before this date are detached",
+    )
+    detach.add_argument("--drop", action="store_true", help="Drop them too")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -1,296 +1,842 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, BackgroundTasks
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from pydantic import ValidationError
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel import select, func
-from json import loads, dumps
+from sqlalchemy import (
+    and_,
+    delete,
+    insert,
+    literal_column,
+    outerjoin,
+    true,
+    tuple_,
+    union_all,
+)
+from orjson import loads, JSONDecodeError
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from csv import DictWriter
+from io import StringIO
 
 
 from redis_client import get_client
-from redis import Redis
-from db import get_session
-from datetime import datetime
-
-from transaction.models import Transaction, TransactionCreate, TransactionUpdate
+from redis.asyncio import Redis
+from db import get_read_session, get_session, read_session, use_primary
+from settings import settings
+from datetime import date, datetime
+from typing import AsyncIterator
+
+from transaction.cache import (
+    NOT_FOUND,
+    REDIS_KEY_ANALYTICS_PERCENTILES,
+    REDIS_KEY_ANALYTICS_SERIES,
+    REDIS_KEY_AVERAGE_TRANSACTION_VALUE,
+    REDIS_KEY_DAY_OF_HIGHEST_NUMBER_OF_TRANSACTIONS,
+    REDIS_KEY_GENERATION,
+    REDIS_KEY_HIGHEST_NUMBER_OF_TRANSACTIONS_IN_A_DAY,
+    REDIS_KEY_TOTAL_CREDIT_VALUE,
+    REDIS_KEY_TOTAL_DEBIT_VALUE,
+    REDIS_KEY_TRANSACTION,
+    REDIS_KEY_TRANSACTION_VERSION,
+    REDIS_KEY_TRANSACTIONS_PAGE,
+    TRANSACTION_VERSION_TTL_SECONDS,
+    TRANSACTIONS_ANALYTICS_TTL_SECONDS,
+    TRANSACTIONS_HISTORY_TTL_SECONDS,
+    TRANSACTIONS_NOT_FOUND_TTL_SECONDS,
+    as_cached,
+    cache_get,
+    cache_mget,
+    encode,
+    etag,
+    fill,
+    get_generation,
+    get_version,
+    get_versions,
+    invalidate_user_cache,
+    json_response,
+    not_modified,
+    remember_analytics_range,
+    store,
+    written_recently,
+)
+from transaction.aggregates import (
+    AggregateDeltas,
+    amount_percentiles,
+    range_totals_by_user_query,
+    range_totals_query,
+    transaction_series,
+    update_aggregates,
+)
+from transaction.batcher import batcher
+from transaction.enums import ExportFormat, SeriesBucket
+from transaction.models import (
+    AnalyticsBatch,
+    Transaction,
+    TransactionBase,
+    TransactionCreate,
+    TransactionUpdate,
+    UserDailyTransactionSummary,
+    UserTransactionSummary,
+)
 
 transaction_router = APIRouter(prefix="/core", tags=["Core"])
 
-TRANSACTIONS_ANALYTICS_TTL_SECONDS = 300
-TRANSACTIONS_HISTORY_TTL_SECONDS = 120
+TRANSACTIONS_PAGE_SIZE = 50
+TRANSACTIONS_BULK_BATCH_SIZE = 1000
+TRANSACTIONS_EXPORT_BATCH_SIZE = 1000
+ANALYTICS_BATCH_QUERY_SIZE = 500
+TRANSACTIONS_BATCH_MAX_IDS = 1000
 
-REDIS_KEY_AVERAGE_TRANSACTION_VALUE = "analytics:{0}:average_transaction_value"
-REDIS_KEY_DAY_OF_HIGHEST_NUMBER_OF_TRANSACTIONS = (
-    "analytics:{0}:day_of_highest_number_of_transactions"
-)
-REDIS_KEY_HIGHEST_NUMBER_OF_TRANSACTIONS_IN_A_DAY = (
-    "analytics:{0}:highest_number_of_transaction_in_a_day"
-)
-REDIS_KEY_TOTAL_DEBIT_VALUE = "analytics:{0}:total_debit_value:{1}:{2}"
-REDIS_KEY_TOTAL_CREDIT_VALUE = "analytics:{0}:total_credit_value:{1}:{2}"
+ANALYTICS_RANGE = "{0}|{1}"
 
 
-async def highest_transactions_in_a_day(rc: Redis, session: AsyncSession, user_id: int):
-    day_of_highest_number_of_transactions = rc.get(
-        REDIS_KEY_DAY_OF_HIGHEST_NUMBER_OF_TRANSACTIONS.format(user_id)
-    )
-    highest_number_of_transactions_in_a_day = rc.get(
-        REDIS_KEY_HIGHEST_NUMBER_OF_TRANSACTIONS_IN_A_DAY.format(user_id)
+async def read_your_writes(rc: Redis, session: AsyncSession, *version_keys: str):
+    """Called before the queries of a cache fill, with the versions the values
+    are cached under. Right after a write they are read from the primary."""
+
+    if await written_recently(rc, *version_keys):
+        await use_primary(session)
+
+
+def busiest_day_query(user_id: int):
+    return (
+        select(
+            UserDailyTransactionSummary.transaction_count,
+            UserDailyTransactionSummary.day,
+        )
+        .where(
+            UserDailyTransactionSummary.user_id == user_id,
+            UserDailyTransactionSummary.transaction_count > 0,
+        )
+        .order_by(
+            UserDailyTransactionSummary.transaction_count.desc(),
+            UserDailyTransactionSummary.day.desc(),
+        )
+        .limit(1)
     )
 
-    if (
-        not day_of_highest_number_of_transactions
-        or not day_of_highest_number_of_transactions
-    ):
-        highest_number_of_transactions_in_a_day = 0
-        day_of_highest_number_of_transactions = "None"
 
-        query = (
+def summary_query(user_id: int):
+    # An aggregate so there is always exactly one row, even for a user without
+    # transactions
+    return select(
+        func.coalesce(func.max(UserTransactionSummary.transaction_total), 0).label(
+            "transaction_total"
+        ),
+        func.coalesce(func.max(UserTransactionSummary.transaction_count), 0).label(
+            "transaction_count"
+        ),
+        func.coalesce(func.max(UserTransactionSummary.credit_total), 0).label(
+            "credit_total"
+        ),
+        func.coalesce(func.max(UserTransactionSummary.debit_total), 0).label(
+            "debit_total"
+        ),
+    ).where(UserTransactionSummary.user_id == user_id)
+
+
+def analytics_query(
+    user_id: int, start: datetime | None = None, end: datetime | None = None
+):
+    """Every analytics metric of a user in a single statement, always exactly
+    one row."""
+
+    summary = summary_query(user_id).subquery()
+    busiest_day = busiest_day_query(user_id).subquery()
+
+    totals = summary
+    tables = summary.outerjoin(busiest_day, true())
+    if start or end:
+        totals = range_totals_query(user_id, start, end).subquery()
+        tables = tables.join(totals, true())
+
+    return select(
+        summary.c.transaction_total,
+        summary.c.transaction_count,
+        busiest_day.c.transaction_count,
+        busiest_day.c.day,
+        totals.c.credit_total,
+        totals.c.debit_total,
+    ).select_from(tables)
+
+
+def analytics_ranges_query(
+    user_id: int, ranges: list[tuple[datetime | None, datetime | None]]
+):
+    """The columns of analytics_query for many date ranges of a user at once,
+    one row per range with its index in ranges in front. The metrics that
+    don't depend on the range are read once."""
+
+    parts = []
+    for index, (start, end) in enumerate(ranges):
+        totals = (
+            range_totals_query(user_id, start, end)
+            if start or end
+            else summary_query(user_id)
+        ).subquery()
+        parts.append(
             select(
-                func.count(Transaction.id).label("transaction_count"),
-                func.date(Transaction.transaction_date).label("transaction_day"),
+                literal_column(str(index)).label("range"),
+                totals.c.credit_total,
+                totals.c.debit_total,
             )
-            .where(Transaction.user_id == user_id)
-            .group_by(func.date(Transaction.transaction_date))
-            .order_by(
-                func.count(Transaction.id).desc(),
-                func.date(Transaction.transaction_date).desc(),
+        )
+
+    summary = summary_query(user_id).subquery()
+    busiest_day = busiest_day_query(user_id).subquery()
+    totals = union_all(*parts).subquery()
+
+    return select(
+        totals.c.range,
+        summary.c.transaction_total,
+        summary.c.transaction_count,
+        busiest_day.c.transaction_count,
+        busiest_day.c.day,
+        totals.c.credit_total,
+        totals.c.debit_total,
+    ).select_from(summary.outerjoin(busiest_day, true()).join(totals, true()))
+
+
+def analytics_batch_query(
+    user_ids: list[int], start: datetime | None = None, end: datetime | None = None
+):
+    """The columns of analytics_query plus the user_id in front, for many
+    users at once. Users without any transactions have no row."""
+
+    busiest_day = (
+        select(
+            UserDailyTransactionSummary.user_id,
+            UserDailyTransactionSummary.transaction_count,
+            UserDailyTransactionSummary.day,
+            func.row_number()
+            .over(
+                partition_by=UserDailyTransactionSummary.user_id,
+                order_by=(
+                    UserDailyTransactionSummary.transaction_count.desc(),
+                    UserDailyTransactionSummary.day.desc(),
+                ),
             )
+            .label("rank"),
         )
-        results = await session.exec(query)
-        if query_results := results.first():
-            (
-                highest_number_of_transactions_in_a_day,
-                day_of_highest_number_of_transactions,
-            ) = query_results
-
-        rc.set(
-            REDIS_KEY_DAY_OF_HIGHEST_NUMBER_OF_TRANSACTIONS.format(user_id),
-            str(day_of_highest_number_of_transactions),
-            TRANSACTIONS_ANALYTICS_TTL_SECONDS,
+        .where(
+            UserDailyTransactionSummary.user_id.in_(user_ids),
+            UserDailyTransactionSummary.transaction_count > 0,
         )
-        rc.set(
-            REDIS_KEY_HIGHEST_NUMBER_OF_TRANSACTIONS_IN_A_DAY.format(user_id),
-            highest_number_of_transactions_in_a_day,
-            TRANSACTIONS_ANALYTICS_TTL_SECONDS,
+        .subquery()
+    )
+
+    credit_total = UserTransactionSummary.credit_total
+    debit_total = UserTransactionSummary.debit_total
+    tables = outerjoin(
+        UserTransactionSummary,
+        busiest_day,
+        and_(
+            busiest_day.c.user_id == UserTransactionSummary.user_id,
+            busiest_day.c.rank == 1,
+        ),
+    )
+    if start or end:
+        totals = range_totals_by_user_query(user_ids, start, end).subquery()
+        credit_total = func.coalesce(totals.c.credit_total, 0)
+        debit_total = func.coalesce(totals.c.debit_total, 0)
+        tables = tables.outerjoin(
+            totals, totals.c.user_id == UserTransactionSummary.user_id
         )
 
-    return [
-        highest_number_of_transactions_in_a_day,
-        day_of_highest_number_of_transactions,
-    ]
+    return (
+        select(
+            UserTransactionSummary.user_id,
+            UserTransactionSummary.transaction_total,
+            UserTransactionSummary.transaction_count,
+            busiest_day.c.transaction_count,
+            busiest_day.c.day,
+            credit_total,
+            debit_total,
+        )
+        .select_from(tables)
+        .where(UserTransactionSummary.user_id.in_(user_ids))
+    )
 
 
-async def transactions_value(
-    rc: Redis,
-    session: AsyncSession,
+def analytics_keys(
     user_id: int,
-    transaction_value_start_date: datetime,
-    transaction_value_end_date: datetime,
-):
-    total_debit_value = rc.get(
-        REDIS_KEY_TOTAL_DEBIT_VALUE.format(
-            user_id,
-            transaction_value_start_date if transaction_value_start_date else "all",
-            transaction_value_end_date if transaction_value_end_date else "all",
-        )
+    generation: int,
+    transaction_value_start_date: datetime | None,
+    transaction_value_end_date: datetime | None,
+) -> list[str]:
+    transaction_value_range = analytics_range(
+        transaction_value_start_date, transaction_value_end_date
     )
-
-    total_credit_value = rc.get(
+    return [
+        REDIS_KEY_AVERAGE_TRANSACTION_VALUE.format(user_id, generation),
+        REDIS_KEY_DAY_OF_HIGHEST_NUMBER_OF_TRANSACTIONS.format(user_id, generation),
+        REDIS_KEY_HIGHEST_NUMBER_OF_TRANSACTIONS_IN_A_DAY.format(user_id, generation),
+        REDIS_KEY_TOTAL_DEBIT_VALUE.format(
+            user_id, generation, *transaction_value_range
+        ),
         REDIS_KEY_TOTAL_CREDIT_VALUE.format(
-            user_id,
-            transaction_value_start_date if transaction_value_start_date else "all",
-            transaction_value_end_date if transaction_value_end_date else "all",
-        )
+            user_id, generation, *transaction_value_range
+        ),
+    ]
+
+
+def analytics_range(
+    transaction_value_start_date: datetime | None,
+    transaction_value_end_date: datetime | None,
+) -> tuple:
+    return (
+        transaction_value_start_date if transaction_value_start_date else "all",
+        transaction_value_end_date if transaction_value_end_date else "all",
     )
 
-    if not total_credit_value or total_debit_value:
-        total_credit_value = 0
-        total_debit_value = 0
 
-        query = (
-            select(
-                Transaction.transaction_type, func.sum(Transaction.transaction_amount)
-            )
-            .where(Transaction.user_id == user_id)
-            .group_by(Transaction.transaction_type)
-        )
+def analytics_values(
+    transaction_total: float = 0,
+    transaction_count: int = 0,
+    highest_number_of_transactions_in_a_day: int | None = None,
+    day_of_highest_number_of_transactions: date | None = None,
+    total_credit_value: float = 0,
+    total_debit_value: float = 0,
+) -> list:
+    """The values cached under analytics_keys, from a row of analytics_query.
+    The defaults are the analytics of a user without transactions."""
 
-        if transaction_value_start_date:
-            query = query.where(
-                Transaction.transaction_date >= transaction_value_start_date
-            )
+    return [
+        round(transaction_total / transaction_count, 2) if transaction_count else 0,
+        day_of_highest_number_of_transactions or "None",
+        highest_number_of_transactions_in_a_day or 0,
+        round(total_debit_value, 2),
+        round(total_credit_value, 2),
+    ]
 
-        if transaction_value_end_date:
-            query = query.where(
-                Transaction.transaction_date <= transaction_value_end_date
-            )
 
-        results = await session.exec(query)
-        final_results = results.all()
+def analytics_payload(values: list[bytes]) -> dict:
+    [
+        average_transaction_value,
+        day_of_highest_number_of_transactions,
+        highest_number_of_transactions_in_a_day,
+        total_debit_value,
+        total_credit_value,
+    ] = values
+
+    return {
+        "average_transaction_value": float(average_transaction_value),
+        "day_of_highest_number_of_transactions": day_of_highest_number_of_transactions.decode(),
+        "highest_number_of_transactions_in_a_day": int(
+            highest_number_of_transactions_in_a_day
+        ),
+        "total_debit_value": float(total_debit_value),
+        "total_credit_value": float(total_credit_value),
+    }
 
-        for x in final_results:
-            if x[0] == "debit":
-                total_debit_value = round(x[1], 2)
-            if x[0] == "credit":
-                total_credit_value = round(x[1], 2)
 
-        rc.set(
-            REDIS_KEY_TOTAL_CREDIT_VALUE.format(
-                user_id,
-                transaction_value_start_date if transaction_value_start_date else "all",
-                transaction_value_end_date if transaction_value_end_date else "all",
-            ),
-            total_credit_value,
+async def user_analytics(
+    rc: Redis,
+    session: AsyncSession,
+    user_id: int,
+    generation: int,
+    transaction_value_start_date: datetime | None,
+    transaction_value_end_date: datetime | None,
+) -> dict:
+    keys = analytics_keys(
+        user_id, generation, transaction_value_start_date, transaction_value_end_date
+    )
+    values = await cache_mget(rc, keys)
+
+    if None in values:
+
+        async def compute():
+            await read_your_writes(rc, session, REDIS_KEY_GENERATION.format(user_id))
+            results = await session.exec(
+                analytics_query(
+                    user_id, transaction_value_start_date, transaction_value_end_date
+                )
+            )
+            return analytics_values(*results.one())
+
+        values = await fill(
+            rc,
+            keys,
             TRANSACTIONS_ANALYTICS_TTL_SECONDS,
-        )
-        rc.set(
-            REDIS_KEY_TOTAL_DEBIT_VALUE.format(
+            compute,
+            lambda pipe: remember_analytics_range(
+                pipe,
                 user_id,
-                transaction_value_start_date if transaction_value_start_date else "all",
-                transaction_value_end_date if transaction_value_end_date else "all",
+                ANALYTICS_RANGE.format(
+                    *analytics_range(
+                        transaction_value_start_date, transaction_value_end_date
+                    )
+                ),
             ),
-            total_debit_value,
-            TRANSACTIONS_ANALYTICS_TTL_SECONDS,
         )
-    return [total_credit_value, total_debit_value]
 
+    return analytics_payload(values)
 
-async def average_transaction(rc: Redis, session: AsyncSession, user_id: int):
-    average_transaction_value = rc.get(
-        REDIS_KEY_AVERAGE_TRANSACTION_VALUE.format(user_id)
-    )
-
-    if not average_transaction_value:
 
-        query = select(func.avg(Transaction.transaction_amount)).where(
-            Transaction.user_id == user_id
+async def batch_analytics(
+    request: Request,
+    rc: Redis,
+    user_ids: list[int],
+    transaction_value_start_date: datetime | None,
+    transaction_value_end_date: datetime | None,
+) -> AsyncIterator[bytes]:
+    for offset in range(0, len(user_ids), ANALYTICS_BATCH_QUERY_SIZE):
+        batch = user_ids[offset : offset + ANALYTICS_BATCH_QUERY_SIZE]
+
+        generations = await cache_mget(
+            rc, [REDIS_KEY_GENERATION.format(user_id) for user_id in batch]
+        )
+        keys = {
+            user_id: analytics_keys(
+                user_id,
+                int(generation) if generation else 0,
+                transaction_value_start_date,
+                transaction_value_end_date,
+            )
+            for user_id, generation in zip(batch, generations)
+        }
+        values = await cache_mget(
+            rc, [key for user_keys in keys.values() for key in user_keys]
         )
-        results = await session.exec(query)
-        query_results = results.first()
-        average_transaction_value = round(query_results if query_results else 0, 2)
 
-        rc.set(
-            REDIS_KEY_AVERAGE_TRANSACTION_VALUE.format(user_id),
-            average_transaction_value,
-            TRANSACTIONS_HISTORY_TTL_SECONDS,
+        computed = {}
+        for user_id, user_values in zip(
+            batch, [values[i : i + 5] for i in range(0, len(values), 5)]
+        ):
+            if None in user_values:
+                computed[user_id] = None
+            else:
+                yield encode({"user_id": user_id, **analytics_payload(user_values)})
+                yield b"\n"
+
+        if not computed:
+            continue
+
+        # Every user that missed is computed by the same grouped query
+        async with read_session(request) as session:
+            await read_your_writes(
+                rc,
+                session,
+                *[REDIS_KEY_GENERATION.format(user_id) for user_id in computed],
+            )
+            results = await session.exec(
+                analytics_batch_query(
+                    list(computed),
+                    transaction_value_start_date,
+                    transaction_value_end_date,
+                )
+            )
+            rows = {user_id: row for user_id, *row in results.all()}
+
+        for user_id in computed:
+            computed[user_id] = [
+                as_cached(value) for value in analytics_values(*rows.get(user_id, ()))
+            ]
+        await store(
+            rc,
+            {
+                key: value
+                for user_id, user_values in computed.items()
+                for key, value in zip(keys[user_id], user_values)
+            },
+            TRANSACTIONS_ANALYTICS_TTL_SECONDS,
         )
 
-    return average_transaction_value
+        for user_id, user_values in computed.items():
+            yield encode({"user_id": user_id, **analytics_payload(user_values)})
+            yield b"\n"
 
 
-async def recompute_analytics_on_create_transaction(
-    rc: Redis, session: AsyncSession, user_id: int
+@transaction_router.post("/")
+async def create_transaction(
+    payload: TransactionCreate,
+    session: AsyncSession = Depends(get_session),
+    rc: Redis = Depends(get_client),
 ):
-    print('INSIDE BACKGROUND TASK')
-    if not rc.get(REDIS_KEY_AVERAGE_TRANSACTION_VALUE.format(user_id)):
+    # TODO - Handle when an error occurs while creating the transaction
+
+    if settings.WRITE_BATCHING_ENABLED:
+        return await batcher.create(rc, payload)
+
+    transaction = Transaction.model_validate(payload)
+    session.add(transaction)
+    await update_aggregates(session, added=[transaction])
+    await session.commit()
+    await session.refresh(transaction)
+
+    # A lookup of the id before it existed may have cached a null
+    await invalidate_user_cache(
+        rc, transaction.user_id, transaction_ids=[transaction.id]
+    )
+
+    return transaction
+
+
+async def bulk_rows(request: Request) -> AsyncIterator[dict]:
+    # NDJSON bodies are read line by line as they arrive, anything else is
+    # expected to be a JSON array
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield loads(line)
+        if buffer.strip():
+            yield loads(buffer)
         return
 
-    await highest_transactions_in_a_day(rc, session, user_id)
+    rows = loads(await request.body())
+    if not isinstance(rows, list):
+        raise RequestValidationError(
+            [
+                {
+                    "type": "list_type",
+                    "loc": ("body",),
+                    "msg": "Input should be a valid list",
+                    "input": rows,
+                }
+            ]
+        )
+    for row in rows:
+        yield row
 
-    for key in rc.scan_iter(match=f"analytics:{user_id}:total_credit_value:*"):
-        start_date = str(key).split(":")[3]
-        end_date = str(key).split(":")[4][:-1]
-    
-    print("START DATE - " + start_date)
-    print("END DATE - " + end_date)
 
-    await transactions_value(
-        rc,
-        session,
-        user_id,
-        None if start_date == "all" else datetime.strptime(start_date, "%Y-%m-%d"),
-        None if end_date == "all" else datetime.strptime(end_date, "%Y-%m-%d"),
+async def insert_transactions(
+    session: AsyncSession, transactions: list[TransactionCreate]
+):
+    # A single executemany, which SQLAlchemy sends as batched multi-row INSERTs
+    await session.exec(
+        insert(Transaction),
+        params=[transaction.model_dump() for transaction in transactions],
     )
-    await average_transaction(rc, session, user_id)
-    
-    print("COMPUTATION COMPLETE")
 
 
-@transaction_router.post("/")
-async def create_transaction(
-    payload: TransactionCreate,
-    background_tasks: BackgroundTasks,
+@transaction_router.post("/bulk")
+async def create_transactions(
+    request: Request,
     session: AsyncSession = Depends(get_session),
     rc: Redis = Depends(get_client),
 ):
-    # TODO - Handle when an error occurs while creating the transaction
+    """Insert a JSON array or an NDJSON stream of transactions. The whole
+    request is one database transaction, an invalid row rejects all of them."""
+
+    deltas = AggregateDeltas()
+    batch = []
+    inserted = 0
+    index = 0
+
+    try:
+        async for row in bulk_rows(request):
+            transaction = TransactionCreate.model_validate(row)
+            batch.append(transaction)
+            deltas.add(transaction)
+            index += 1
+
+            if len(batch) == TRANSACTIONS_BULK_BATCH_SIZE:
+                await insert_transactions(session, batch)
+                inserted += len(batch)
+                batch = []
+
+    except JSONDecodeError as e:
+        raise RequestValidationError(
+            [
+                {
+                    "type": "json_invalid",
+                    "loc": ("body", index),
+                    "msg": "JSON decode error",
+                    "input": {},
+                    "ctx": {"error": e.msg},
+                }
+            ]
+        )
+    except ValidationError as e:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", index, *error["loc"])}
+                for error in e.errors(include_url=False)
+            ]
+        )
 
-    transaction = Transaction.model_validate(payload)
-    session.add(transaction)
+    if batch:
+        await insert_transactions(session, batch)
+        inserted += len(batch)
+
+    # Aggregates and caches are updated once per affected user, not per row
+    await deltas.apply(session)
     await session.commit()
-    await session.refresh(transaction)
 
-    for key in rc.scan_iter(match=f"transactions:{transaction.user_id}:*"):
-        rc.delete(key)
+    if deltas.user_ids:
+        await invalidate_user_cache(rc, *deltas.user_ids)
+
+    return {"inserted": inserted}
+
+
+def encode_cursor(transaction: Transaction) -> str:
+    raw = f"{transaction.transaction_date.isoformat()}|{transaction.id}"
+    return urlsafe_b64encode(raw.encode()).decode()
 
-    for key in rc.scan_iter(match=f"analytics:{transaction.user_id}:*"):
-        rc.delete(key)
 
-    background_tasks.add_task(
-        recompute_analytics_on_create_transaction, rc, session, transaction.user_id
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        transaction_date, id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(transaction_date), int(id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+
+def transactions_page_query(
+    user_id: int | None, cursor_date: datetime | None, cursor_id: int | None
+):
+    # Keyset pagination on (transaction_date, id), newest first. Each page only
+    # reads TRANSACTIONS_PAGE_SIZE rows off the index no matter how deep it is.
+    # One row more than a page is read to know whether there is a next page.
+    query = (
+        select(Transaction)
+        .order_by(Transaction.transaction_date.desc(), Transaction.id.desc())
+        .limit(TRANSACTIONS_PAGE_SIZE + 1)
     )
 
-    return transaction
+    if user_id:
+        query = query.where(Transaction.user_id == user_id)
+
+    if cursor_date:
+        query = query.where(
+            tuple_(Transaction.transaction_date, Transaction.id)
+            < tuple_(cursor_date, cursor_id),
+            # Implied by the row comparison, spelled out so the partitions of
+            # later months are pruned
+            Transaction.transaction_date <= cursor_date,
+        )
+
+    return query
+
+
+async def transactions_page(
+    rc: Redis,
+    session: AsyncSession,
+    user_id: int | str,
+    generation: int,
+    cursor: str | None,
+) -> bytes:
+    cache_key = REDIS_KEY_TRANSACTIONS_PAGE.format(
+        user_id, generation, cursor if cursor else "first"
+    )
+    cache_data = await cache_get(rc, cache_key)
+
+    if cache_data:
+        return cache_data
+
+    query = transactions_page_query(
+        None if user_id == "all" else user_id,
+        *(decode_cursor(cursor) if cursor else (None, None)),
+    )
+
+    async def compute():
+        await read_your_writes(rc, session, REDIS_KEY_GENERATION.format(user_id))
+        results = await session.exec(query)
+        transactions = results.all()
+
+        next_cursor = None
+        if len(transactions) > TRANSACTIONS_PAGE_SIZE:
+            transactions = transactions[:TRANSACTIONS_PAGE_SIZE]
+            next_cursor = encode_cursor(transactions[-1])
+
+        return [encode({"transactions": transactions, "next_cursor": next_cursor})]
+
+    [payload] = await fill(rc, [cache_key], TRANSACTIONS_HISTORY_TTL_SECONDS, compute)
+
+    return payload
 
 
 @transaction_router.get("/")
 async def read_transactions(
-    session: AsyncSession = Depends(get_session),
+    request: Request,
+    session: AsyncSession = Depends(get_read_session),
     rc: Redis = Depends(get_client),
     user_id: int = Query(None),
-    page: int = Query(1),
+    cursor: str = Query(None),
 ):
-    transactions = []
-
     if not user_id:
         user_id = "all"
 
-    cache_data = rc.get(f"transactions:{user_id}:{page}")
+    generation = await get_generation(rc, user_id)
+    tag = etag(user_id, generation)
+    if response := not_modified(request, tag):
+        return response
 
-    if cache_data:
-        transactions = loads(cache_data)
+    return json_response(
+        await transactions_page(rc, session, user_id, generation, cursor), tag
+    )
+
+
+TRANSACTION_EXPORT_COLUMNS = [
+    "id",
+    "user_id",
+    "full_name",
+    "transaction_date",
+    "transaction_amount",
+    "transaction_type",
+]
+
+
+def csv_row(row) -> dict:
+    transaction_date = row.transaction_date
+    return {
+        **row._mapping,
+        "transaction_date": transaction_date.isoformat() if transaction_date else None,
+        "transaction_type": row.transaction_type.value,
+    }
+
+
+async def export_transactions(
+    request: Request,
+    format: ExportFormat,
+    user_id: int | None,
+    start_date: datetime | None,
+    end_date: datetime | None,
+):
+    query = select(
+        *(getattr(Transaction, column) for column in TRANSACTION_EXPORT_COLUMNS)
+    ).order_by(Transaction.transaction_date, Transaction.id)
+
+    if user_id:
+        query = query.where(Transaction.user_id == user_id)
+    if start_date:
+        query = query.where(Transaction.transaction_date >= start_date)
+    if end_date:
+        query = query.where(Transaction.transaction_date <= end_date)
+
+    if format == ExportFormat.CSV:
+        yield ",".join(TRANSACTION_EXPORT_COLUMNS) + "\n"
+
+    # The request's session is closed before a streaming response starts, so
+    # the export runs on its own. stream() reads through a server side cursor
+    # a partition at a time, memory stays flat however many rows there are.
+    async with read_session(request) as session:
+        results = await session.stream(
+            query.execution_options(yield_per=TRANSACTIONS_EXPORT_BATCH_SIZE)
+        )
+        async for rows in results.partitions():
+            if format == ExportFormat.CSV:
+                buffer = StringIO()
+                writer = DictWriter(buffer, TRANSACTION_EXPORT_COLUMNS)
+                writer.writerows(csv_row(row) for row in rows)
+                yield buffer.getvalue()
+            else:
+                yield b"".join(encode(row._asdict()) + b"\n" for row in rows)
+
+
+# Declared before /{id} so "export" isn't matched as a transaction id
+@transaction_router.get("/export")
+async def export(
+    request: Request,
+    format: ExportFormat = Query(ExportFormat.NDJSON),
+    user_id: int = Query(None),
+    start_date: datetime = Query(None),
+    end_date: datetime = Query(None),
+):
+    media_type = "text/csv" if format == ExportFormat.CSV else "application/x-ndjson"
+    return StreamingResponse(
+        export_transactions(request, format, user_id, start_date, end_date),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename=transactions.{format.value}"
+        },
+    )
 
-    else:
-        query = select(Transaction)
 
-        if user_id != "all":
-            query = query.where(Transaction.user_id == user_id)
+@transaction_router.get("/batch")
+async def read_transactions_by_id(
+    ids: list[int] = Query(max_length=TRANSACTIONS_BATCH_MAX_IDS),
+    session: AsyncSession = Depends(get_read_session),
+    rc: Redis = Depends(get_client),
+):
+    # Read before the transactions, like the version of a single one
+    versions = await get_versions(
+        rc,
+        [REDIS_KEY_TRANSACTION_VERSION.format(id) for id in ids],
+        TRANSACTION_VERSION_TTL_SECONDS,
+    )
+    keys = {
+        id: REDIS_KEY_TRANSACTION.format(id, version)
+        for id, version in zip(ids, versions)
+    }
+    payloads = dict(zip(keys, await cache_mget(rc, list(keys.values()))))
 
+    if missing := [id for id, payload in payloads.items() if payload is None]:
+        await read_your_writes(
+            rc,
+            session,
+            *[REDIS_KEY_TRANSACTION_VERSION.format(id) for id in missing],
+        )
+        query = select(Transaction).where(Transaction.id.in_(missing))
         results = await session.exec(query)
-        transactions = results.all()
+        found = {transaction.id: transaction for transaction in results.all()}
 
-        rc.set(
-            f"transactions:{user_id}:{page}",
-            dumps(jsonable_encoder(transactions)),
+        for id in missing:
+            payloads[id] = encode(found.get(id))
+        await store(
+            rc,
+            {keys[id]: payloads[id] for id in missing},
             TRANSACTIONS_HISTORY_TTL_SECONDS,
+            not_found_ttl=TRANSACTIONS_NOT_FOUND_TTL_SECONDS,
         )
 
-    return transactions
+    # The cached payloads are already JSON, the response is put together
+    # around them. Missing ids are null, in the order they were asked for.
+    return json_response(
+        b'{"transactions":[' + b",".join(payloads[id] for id in ids) + b"]}"
+    )
+
+
+def transaction_response(request: Request, payload: bytes, tag: str) -> Response:
+    # Ids that don't exist aren't tagged, bulk inserts create them without
+    # bumping their version
+    if payload == NOT_FOUND:
+        return json_response(payload)
+    return not_modified(request, tag) or json_response(payload, tag)
 
 
 @transaction_router.get("/{id}")
 async def read_transaction(
+    request: Request,
     id: int,
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
     rc: Redis = Depends(get_client),
 ):
-    transaction = None
+    # Read before the transaction, the tag is never newer than the body
+    version = await get_version(
+        rc, REDIS_KEY_TRANSACTION_VERSION.format(id), TRANSACTION_VERSION_TTL_SECONDS
+    )
+    tag = etag(id, version)
+    # Whether the id exists is only known from the body, "*" is answered after
+    if response := not_modified(request, tag, exists=False):
+        return response
 
-    cache_data = rc.get(f"transaction:{id}")
+    cache_key = REDIS_KEY_TRANSACTION.format(id, version)
+    cache_data = await cache_get(rc, cache_key)
 
     if cache_data:
-        transaction = loads(cache_data)
+        return transaction_response(request, cache_data, tag)
 
-    else:
+    async def compute():
+        await read_your_writes(rc, session, REDIS_KEY_TRANSACTION_VERSION.format(id))
         query = select(Transaction).where(Transaction.id == id)
         results = await session.exec(query)
-        transaction = results.first()
-        rc.set(
-            f"transaction:{id}",
-            dumps(jsonable_encoder(transaction)),
-            TRANSACTIONS_HISTORY_TTL_SECONDS,
-        )
+        return [encode(results.first())]
 
-    return transaction
+    [payload] = await fill(
+        rc,
+        [cache_key],
+        TRANSACTIONS_HISTORY_TTL_SECONDS,
+        compute,
+        not_found_ttl=TRANSACTIONS_NOT_FOUND_TTL_SECONDS,
+    )
+
+    return transaction_response(request, payload, tag)
 
 
 @transaction_router.put("/{id}")
@@ -302,13 +848,20 @@ async def update_transaction(
 ):
     transaction = None
 
-    query = select(Transaction).where(Transaction.id == id)
+    # Locked until commit, a concurrent update or delete of the same row waits
+    # and then reads what this one left, so the row's old values are never
+    # taken out of the aggregates twice
+    query = select(Transaction).where(Transaction.id == id).with_for_update()
     results = await session.exec(query)
     transaction = results.first()
 
     if not transaction:
         raise HTTPException(404, "Transaction with the given ID does not exist")
 
+    # The transaction may be moved to another user, both users' caches go stale
+    previous_user_id = transaction.user_id
+    previous_transaction = TransactionBase.model_validate(transaction.model_dump())
+
     transaction_data = payload.model_dump(
         exclude_unset=True,
         exclude_defaults=True,
@@ -318,16 +871,17 @@ async def update_transaction(
         setattr(transaction, key, value)
 
     session.add(transaction)
+    # Raises if the row is gone, before its deltas are applied
+    await session.flush()
+    await update_aggregates(
+        session, added=[transaction], removed=[previous_transaction]
+    )
     await session.commit()
     await session.refresh(transaction)
 
-    rc.delete(f"transaction:{id}")
-
-    for key in rc.scan_iter(match=f"transactions:{transaction.user_id}:*"):
-        rc.delete(key)
-
-    for key in rc.scan_iter(f"analytics:{transaction.user_id}:*"):
-        rc.delete(key)
+    await invalidate_user_cache(
+        rc, previous_user_id, transaction.user_id, transaction_ids=[id]
+    )
 
     return transaction
 
@@ -340,52 +894,168 @@ async def delete_transaction(
 ):
     transaction = None
 
-    query = select(Transaction).where(Transaction.id == id)
+    # Locked until commit, a concurrent update or delete of the same row waits
+    # and then reads what this one left, so the row's old values are never
+    # taken out of the aggregates twice
+    query = select(Transaction).where(Transaction.id == id).with_for_update()
     results = await session.exec(query)
     transaction = results.first()
 
     if not transaction:
         raise HTTPException(404, "Transaction with the given ID does not exist")
 
-    await session.delete(transaction)
+    results = await session.exec(delete(Transaction).where(Transaction.id == id))
+    if not results.rowcount:
+        raise HTTPException(404, "Transaction with the given ID does not exist")
+    await update_aggregates(session, removed=[transaction])
     await session.commit()
 
-    rc.delete(f"transaction:{id}")
+    await invalidate_user_cache(rc, transaction.user_id, transaction_ids=[id])
 
-    for key in rc.scan_iter(match=f"transactions:{transaction.user_id}:*"):
-        rc.delete(key)
+    return
 
-    for key in rc.scan_iter(f"analytics:{transaction.user_id}:*"):
-        rc.delete(key)
 
-    return
+@transaction_router.post("/analytics/batch")
+async def read_batch_analytics(
+    request: Request,
+    payload: AnalyticsBatch,
+    rc: Redis = Depends(get_client),
+):
+    # Cached users are streamed first, every user_id that was asked for gets
+    # exactly one line
+    return StreamingResponse(
+        batch_analytics(
+            request,
+            rc,
+            list(dict.fromkeys(payload.user_ids)),
+            payload.transaction_value_start_date,
+            payload.transaction_value_end_date,
+        ),
+        media_type="application/x-ndjson",
+    )
+
+
+async def percentiles_response(
+    request: Request,
+    session: AsyncSession,
+    rc: Redis,
+    user_id: int | None,
+    start_date: datetime | None,
+    end_date: datetime | None,
+) -> Response:
+    # Every user's percentiles change with any user's writes, like the listing
+    # across every user
+    generation_user_id = user_id or "all"
+    generation = await get_generation(rc, generation_user_id)
+    tag = etag(generation_user_id, generation)
+    if response := not_modified(request, tag):
+        return response
+
+    cache_key = REDIS_KEY_ANALYTICS_PERCENTILES.format(
+        generation_user_id, generation, *analytics_range(start_date, end_date)
+    )
+    cache_data = await cache_get(rc, cache_key)
+
+    if cache_data:
+        return json_response(cache_data, tag)
+
+    async def compute():
+        await read_your_writes(
+            rc, session, REDIS_KEY_GENERATION.format(generation_user_id)
+        )
+        return [
+            encode(await amount_percentiles(session, user_id, start_date, end_date))
+        ]
+
+    [payload] = await fill(rc, [cache_key], TRANSACTIONS_ANALYTICS_TTL_SECONDS, compute)
+
+    return json_response(payload, tag)
+
+
+@transaction_router.get("/analytics/percentiles", status_code=200)
+async def all_users_analytics_percentiles(
+    request: Request,
+    start_date: datetime = Query(None),
+    end_date: datetime = Query(None),
+    session: AsyncSession = Depends(get_read_session),
+    rc: Redis = Depends(get_client),
+):
+    return await percentiles_response(request, session, rc, None, start_date, end_date)
 
 
 @transaction_router.get("/{user_id}/analytics", status_code=200)
 async def analytics(
+    request: Request,
     user_id: int,
     transaction_value_start_date: datetime = Query(None),
     transaction_value_end_date: datetime = Query(None),
-    session: AsyncSession = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
     rc: Redis = Depends(get_client),
 ):
+    generation = await get_generation(rc, user_id)
+    tag = etag(user_id, generation)
+    if response := not_modified(request, tag):
+        return response
+
+    return json_response(
+        encode(
+            await user_analytics(
+                rc,
+                session,
+                user_id,
+                generation,
+                transaction_value_start_date,
+                transaction_value_end_date,
+            )
+        ),
+        tag,
+    )
 
-    average_transaction_value = await average_transaction(rc, session, user_id)
 
-    [highest_number_of_transactions_in_a_day, day_of_highest_number_of_transactions] = (
-        await highest_transactions_in_a_day(rc, session, user_id)
-    )
+@transaction_router.get("/{user_id}/analytics/series", status_code=200)
+async def analytics_series(
+    request: Request,
+    user_id: int,
+    bucket: SeriesBucket = Query(SeriesBucket.DAY),
+    start_date: datetime = Query(None),
+    end_date: datetime = Query(None),
+    session: AsyncSession = Depends(get_read_session),
+    rc: Redis = Depends(get_client),
+):
+    generation = await get_generation(rc, user_id)
+    tag = etag(user_id, generation)
+    if response := not_modified(request, tag):
+        return response
 
-    [total_credit_value, total_debit_value] = await transactions_value(
-        rc, session, user_id, transaction_value_start_date, transaction_value_end_date
+    cache_key = REDIS_KEY_ANALYTICS_SERIES.format(
+        user_id, generation, bucket.value, *analytics_range(start_date, end_date)
     )
+    cache_data = await cache_get(rc, cache_key)
 
-    return {
-        "average_transaction_value": float(average_transaction_value),
-        "day_of_highest_number_of_transactions": day_of_highest_number_of_transactions,
-        "highest_number_of_transactions_in_a_day": int(
-            highest_number_of_transactions_in_a_day
-        ),
-        "total_debit_value": float(total_debit_value),
-        "total_credit_value": float(total_credit_value),
-    }
+    if cache_data:
+        return json_response(cache_data, tag)
+
+    async def compute():
+        await read_your_writes(rc, session, REDIS_KEY_GENERATION.format(user_id))
+        series = await transaction_series(
+            session, user_id, bucket, start_date, end_date
+        )
+        return [encode({"bucket": bucket, "series": series})]
+
+    [payload] = await fill(rc, [cache_key], TRANSACTIONS_ANALYTICS_TTL_SECONDS, compute)
+
+    return json_response(payload, tag)
+
+
+@transaction_router.get("/{user_id}/analytics/percentiles", status_code=200)
+async def analytics_percentiles(
+    request: Request,
+    user_id: int,
+    start_date: datetime = Query(None),
+    end_date: datetime = Query(None),
+    session: AsyncSession = Depends(get_read_session),
+    rc: Redis = Depends(get_client),
+):
+    return await percentiles_response(
+        request, session, rc, user_id, start_date, end_date
+    )
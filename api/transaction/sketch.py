@@ -0,0 +1,61 @@
+"""Quantiles of transaction amounts from DDSketch buckets.
+
+An amount is counted in the bucket of its logarithm base GAMMA, every amount
+in a bucket is within AMOUNT_SKETCH_RELATIVE_ACCURACY of the bucket's value.
+A sketch is just a count per bucket, so sketches are merged by adding up the
+counts of the same buckets, which is how the daily sketches of any date range
+are read (see amount_sketch_query).
+
+Changing the accuracy or the smallest amount moves amounts to other buckets,
+the rows already written have to be rebuilt (rebuild_aggregates) after.
+"""
+
+from math import ceil, log
+
+AMOUNT_SKETCH_RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + AMOUNT_SKETCH_RELATIVE_ACCURACY) / (1 - AMOUNT_SKETCH_RELATIVE_ACCURACY)
+LOG_GAMMA = log(GAMMA)
+
+# Amounts closer to 0 than this are counted as 0, in bucket 0. Buckets of
+# larger amounts are shifted to start at 1, negative amounts mirror them.
+AMOUNT_SKETCH_MIN_AMOUNT = 1e-4
+AMOUNT_SKETCH_BUCKET_OFFSET = 1 - ceil(log(AMOUNT_SKETCH_MIN_AMOUNT) / LOG_GAMMA)
+
+
+def amount_bucket(amount: float) -> int:
+    if abs(amount) < AMOUNT_SKETCH_MIN_AMOUNT:
+        return 0
+
+    bucket = ceil(log(abs(amount)) / LOG_GAMMA) + AMOUNT_SKETCH_BUCKET_OFFSET
+    return bucket if amount > 0 else -bucket
+
+
+def bucket_amount(bucket: int) -> float:
+    if bucket == 0:
+        return 0.0
+
+    index = abs(bucket) - AMOUNT_SKETCH_BUCKET_OFFSET
+    amount = 2 * GAMMA**index / (GAMMA + 1)
+    return amount if bucket > 0 else -amount
+
+
+class AmountSketch:
+    def __init__(self, counts: dict[int, int] | None = None):
+        self.counts = {
+            bucket: count for bucket, count in (counts or {}).items() if count
+        }
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def quantile(self, q: float) -> float | None:
+        """The amount at rank q * (count - 1), None for an empty sketch."""
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen > rank:
+                return bucket_amount(bucket)
+        return None
@@ -0,0 +1,55 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+from redis.asyncio import Redis
+from sqlmodel import func, select
+
+from db import async_session
+from settings import settings
+from transaction.cache import get_generation
+from transaction.models import UserDailyTransactionSummary
+from transaction.routes import transactions_page, user_analytics
+
+logger = logging.getLogger(__name__)
+
+
+def most_active_users_query(limit: int, days: int):
+    since = datetime.now(timezone.utc).date() - timedelta(days=days)
+    transaction_count = func.sum(UserDailyTransactionSummary.transaction_count)
+
+    return (
+        select(UserDailyTransactionSummary.user_id)
+        .where(UserDailyTransactionSummary.day >= since)
+        .group_by(UserDailyTransactionSummary.user_id)
+        .order_by(transaction_count.desc())
+        .limit(limit)
+    )
+
+
+async def run(rc: Redis):
+    """Cache the analytics and first listing page of the users with the most
+    transactions in the last CACHE_WARMUP_DAYS, and the first page across all
+    users. Runs once in the background, requests are served meanwhile and
+    whatever is already cached is left as it is."""
+
+    try:
+        async with async_session() as session:
+            results = await session.exec(
+                most_active_users_query(
+                    settings.CACHE_WARMUP_USERS, settings.CACHE_WARMUP_DAYS
+                )
+            )
+            user_ids = results.all()
+
+            await transactions_page(
+                rc, session, "all", await get_generation(rc, "all"), None
+            )
+            for user_id in user_ids:
+                generation = await get_generation(rc, user_id)
+                await user_analytics(rc, session, user_id, generation, None, None)
+                await transactions_page(rc, session, user_id, generation, None)
+    except Exception:
+        logger.exception("Warming up the cache failed")
+        return
+
+    logger.info("Warmed up the cache of %d users", len(user_ids))
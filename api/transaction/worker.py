@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import socket
+from collections import defaultdict
+from datetime import datetime
+from time import monotonic
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db import async_session
+from redis_client import create_client
+from settings import settings
+from transaction.cache import (
+    REDIS_STREAM_ANALYTICS_RECOMPUTE,
+    TRANSACTIONS_ANALYTICS_TTL_SECONDS,
+    as_cached,
+    cache_mget,
+    get_generation,
+    recent_analytics_ranges,
+    store,
+)
+from transaction.routes import (
+    ANALYTICS_RANGE,
+    analytics_keys,
+    analytics_ranges_query,
+    analytics_values,
+)
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_RECOMPUTE_GROUP = "analytics_recompute"
+ANALYTICS_RECOMPUTE_BATCH_SIZE = 500
+ANALYTICS_RECOMPUTE_BLOCK_MILLISECONDS = 5000
+
+# Messages another consumer read but never acknowledged (it crashed, or the
+# recompute failed) are taken over once they have been pending this long
+ANALYTICS_RECOMPUTE_CLAIM_IDLE_MILLISECONDS = 60_000
+
+# Messages that failed this many times are dropped instead of being claimed
+# again forever, the user's analytics are then computed by the next request
+ANALYTICS_RECOMPUTE_MAX_DELIVERIES = 5
+
+
+def stream_messages(response) -> list:
+    # RESP3 replies map the stream name to [messages], RESP2 replies are a
+    # list of [stream name, messages]
+    if isinstance(response, dict):
+        return [message for value in response.values() for message in value[0]]
+    return [message for _, messages in response or [] for message in messages]
+
+
+def parse_analytics_range(analytics_range: bytes) -> list[datetime | None]:
+    return [
+        None if value == "all" else datetime.fromisoformat(value)
+        for value in analytics_range.decode().split("|")
+    ]
+
+
+async def create_group(rc: Redis):
+    try:
+        await rc.xgroup_create(
+            REDIS_STREAM_ANALYTICS_RECOMPUTE,
+            ANALYTICS_RECOMPUTE_GROUP,
+            id="0",
+            mkstream=True,
+        )
+    except ResponseError as error:
+        if "BUSYGROUP" not in str(error):
+            raise
+
+
+async def drop_undeliverable(rc: Redis, consumer: str, messages: list) -> list:
+    pending = await rc.xpending_range(
+        REDIS_STREAM_ANALYTICS_RECOMPUTE,
+        ANALYTICS_RECOMPUTE_GROUP,
+        min=messages[0][0],
+        max=messages[-1][0],
+        count=len(messages),
+        consumername=consumer,
+    )
+    dropped = {
+        message["message_id"]
+        for message in pending
+        if message["times_delivered"] > ANALYTICS_RECOMPUTE_MAX_DELIVERIES
+    }
+    if not dropped:
+        return messages
+
+    logger.error(
+        "Dropping %d analytics recomputes that failed %d times",
+        len(dropped),
+        ANALYTICS_RECOMPUTE_MAX_DELIVERIES,
+    )
+    await rc.xack(REDIS_STREAM_ANALYTICS_RECOMPUTE, ANALYTICS_RECOMPUTE_GROUP, *dropped)
+    return [message for message in messages if message[0] not in dropped]
+
+
+async def read_batch(rc: Redis, consumer: str) -> list:
+    """Wait for the next write, then keep reading for the debounce window so a
+    burst of writes for the same users is recomputed once."""
+
+    _, messages, *_ = await rc.xautoclaim(
+        REDIS_STREAM_ANALYTICS_RECOMPUTE,
+        ANALYTICS_RECOMPUTE_GROUP,
+        consumer,
+        ANALYTICS_RECOMPUTE_CLAIM_IDLE_MILLISECONDS,
+        count=ANALYTICS_RECOMPUTE_BATCH_SIZE,
+    )
+    messages = [message for message in messages if message and message[1]]
+    if messages:
+        messages = await drop_undeliverable(rc, consumer, messages)
+
+    if not messages:
+        messages = stream_messages(
+            await rc.xreadgroup(
+                ANALYTICS_RECOMPUTE_GROUP,
+                consumer,
+                {REDIS_STREAM_ANALYTICS_RECOMPUTE: ">"},
+                count=ANALYTICS_RECOMPUTE_BATCH_SIZE,
+                block=ANALYTICS_RECOMPUTE_BLOCK_MILLISECONDS,
+            )
+        )
+        if not messages:
+            return []
+
+    deadline = monotonic() + settings.ANALYTICS_RECOMPUTE_DEBOUNCE_SECONDS
+    while len(messages) < ANALYTICS_RECOMPUTE_BATCH_SIZE:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        messages += stream_messages(
+            await rc.xreadgroup(
+                ANALYTICS_RECOMPUTE_GROUP,
+                consumer,
+                {REDIS_STREAM_ANALYTICS_RECOMPUTE: ">"},
+                count=ANALYTICS_RECOMPUTE_BATCH_SIZE - len(messages),
+                block=max(1, int(remaining * 1000)),
+            )
+        )
+
+    return messages
+
+
+async def recompute_user_analytics(rc: Redis, session: AsyncSession, user_id: int):
+    # The generation is read before any query so the values computed are at
+    # least as new as the writes it covers
+    generation = await get_generation(rc, user_id)
+    ranges = [
+        parse_analytics_range(analytics_range)
+        for analytics_range in dict.fromkeys(
+            [
+                ANALYTICS_RANGE.format("all", "all").encode(),
+                *await recent_analytics_ranges(rc, user_id),
+            ]
+        )
+    ]
+    keys = [analytics_keys(user_id, generation, *dates) for dates in ranges]
+
+    # Ranges a request already computed under the generation are left alone
+    values = await cache_mget(rc, [key for range_keys in keys for key in range_keys])
+    missing = [
+        index
+        for index, range_keys in enumerate(keys)
+        if None in values[index * len(range_keys) : (index + 1) * len(range_keys)]
+    ]
+    if not missing:
+        return
+
+    results = await session.exec(
+        analytics_ranges_query(user_id, [ranges[index] for index in missing])
+    )
+    await store(
+        rc,
+        {
+            key: as_cached(value)
+            for index, *row in results.all()
+            for key, value in zip(keys[missing[index]], analytics_values(*row))
+        },
+        TRANSACTIONS_ANALYTICS_TTL_SECONDS,
+    )
+
+
+async def recompute(rc: Redis, messages: list):
+    message_ids = defaultdict(list)
+    for message_id, fields in messages:
+        message_ids[int(fields[b"user_id"])].append(message_id)
+
+    done = []
+    async with async_session() as session:
+        for user_id in sorted(message_ids):
+            try:
+                await recompute_user_analytics(rc, session, user_id)
+            except Exception:
+                # Left pending to be claimed again, the other users still are
+                # recomputed and acknowledged
+                logger.exception("Recomputing the analytics of user %d failed", user_id)
+                await session.rollback()
+                continue
+            done += message_ids[user_id]
+
+    if done:
+        await rc.xack(
+            REDIS_STREAM_ANALYTICS_RECOMPUTE, ANALYTICS_RECOMPUTE_GROUP, *done
+        )
+
+
+async def run(rc: Redis, consumer: str | None = None):
+    """Recompute and cache the analytics of every user that was written to,
+    for the default range and every range recently asked for. Runs until
+    cancelled. Several workers can share the stream, each message goes to one
+    of them."""
+
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    group_created = False
+
+    while True:
+        try:
+            if not group_created:
+                await create_group(rc)
+                group_created = True
+
+            messages = await read_batch(rc, consumer)
+            if messages:
+                await recompute(rc, messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            if "NOGROUP" in str(error):
+                # The stream was deleted (Redis was flushed or restarted
+                # without persistence) and the group with it
+                group_created = False
+                continue
+
+            # Unacknowledged messages stay pending and are claimed again
+            logger.exception("Recomputing analytics failed")
+            await asyncio.sleep(1)
+
+
+async def main():
+    rc = create_client()
+    try:
+        await run(rc)
+    finally:
+        await rc.aclose()
+
+
+if __name__ == "__main__":
+    # Standalone worker, for running it apart from the API processes (set
+    # ANALYTICS_WORKER_ENABLED=false on those)
+    asyncio.run(main())